@@ -1,21 +1,28 @@
-from contextlib import asynccontextmanager
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from typing import Optional
-import asyncpg
 from dotenv.main import load_dotenv
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pathlib import Path
 
 from src.utils import color_a_hex
 load_dotenv()
 
 from src.whatsapp.model import Brand
+from src.whatsapp.media import media_store
 
 
 
-from src.veyra.img_gen import upload_to_s3
+from src.veyra.s3 import upload_to_s3
+from src.veyra.metrics import render_prometheus
+from src.veyra.step_metrics import live_percentiles
+from src.veyra.jobs import JobQueue
+from src.veyra.message_buffer import MESSAGE_BUFFER_ENABLED, MessageBuffer
+from src.veyra.runtime import app_runtime
+from src.veyra.worker import build_worker
 
 from fastapi import FastAPI
-from src.veyra.persistence import Storage, db_pool
+from src.veyra.persistence import Storage
 import os
 from agno.agent import Agent
 
@@ -28,11 +35,10 @@ from agno.storage.postgres import PostgresStorage
 from agno.memory.v2.db.postgres import PostgresMemoryDb
 from src.marketing.instructions import instructions
 
-from src.veyra.persistence import PostgresStorage as VeyraPostgresStorage
 
 from langfuse import get_client
-from src.veyra.workflow import renderer
 import openlit
+from sqlalchemy import create_engine
 
 logger = logging.getLogger(__name__)
 langfuse = get_client()
@@ -41,15 +47,22 @@ openlit.init(tracer=langfuse._otel_tracer, disable_batch=True, application_name=
 
 db_url = os.environ['POSTGRES_URL']
 
+# agno's storage and memory are sync SQLAlchemy, so they cannot borrow the asyncpg
+# pool; they share one small engine instead of each opening their own.
+agno_engine = create_engine(
+    db_url,
+    pool_size=int(os.getenv("AGNO_POOL_SIZE", "2")),
+    max_overflow=int(os.getenv("AGNO_POOL_MAX_OVERFLOW", "1")),
+    pool_recycle=int(os.getenv("POSTGRES_POOL_IDLE_TIMEOUT", "60")),
+    pool_pre_ping=True,
+)
+
 logger = logging.getLogger(__name__)
 
 async def get_storage() -> Storage:
-    global agent_storage
+    """The storage (and pool) created in the lifespan; tools never open their own."""
     if agent_storage is None:
-        pool = await asyncpg.create_pool(dsn=db_url, statement_cache_size=0,  # <- clave
-        max_cached_statement_lifetime=0,  # opcional, aún más seguro
-        max_cacheable_statement_size=0,)
-        agent_storage = VeyraPostgresStorage(pool)
+        raise RuntimeError("Storage is not initialised, the app lifespan is not running")
     return agent_storage
 
 async def generate_call_link(agent: Agent):
@@ -65,13 +78,20 @@ async def save_logo(input, agent: Agent) -> Optional[str]:
     This tools allows the agent to store the logo image, no parameters are required since
     the image is already in the context.
     """
+    media_id = agent.session_state.get("__image_media_id", None)
+    if media_id:
+        # Reused while the media store still holds it, downloaded again from WhatsApp otherwise
+        item = await media_store.fetch(media_id)
+        return await upload_to_s3(await asyncio.to_thread(item.getvalue))
+
+    # Sessions saved before the image was kept by media id
     image = agent.session_state.get("__image_path", None)
     if not image:
         return None
     
     path = Path(image)
     if not path.exists():
-        raise FileNotFoundError(f"No se encontró el archivo {file_path}")
+        raise FileNotFoundError(f"No se encontró el archivo {path}")
 
     # Leer bytes
     with open(path, "rb") as f:
@@ -121,12 +141,12 @@ media_agent = Agent(
     num_history_responses=20,
     num_history_runs=5,
     storage=PostgresStorage(
-        table_name="agent_sessions", db_url=db_url, schema="public"
+        table_name="agent_sessions", db_engine=agno_engine, schema="public"
     ),
     memory=Memory(
         db=PostgresMemoryDb(
             table_name="agent_memories",
-            db_url=db_url,
+            db_engine=agno_engine,
             schema="public"
         )
     ),
@@ -145,14 +165,30 @@ whatsapp_app = WhatsappAPI(
     session_state_loader=build_context
 )
 
+# Run the job worker inside the web process too (handy locally; disable when
+# dedicated worker machines are deployed).
+EMBEDDED_WORKER = os.getenv("EMBEDDED_WORKER", "true").lower() in ("1", "true", "yes")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage the database connection pool during the app's lifecycle."""
-    async with db_pool() as pool:
-        storage = VeyraPostgresStorage(pool)
+    global agent_storage
+    async with app_runtime() as storage:
         app.state.storage = storage
+        agent_storage = storage
+        app.state.jobs = JobQueue(storage.pool)
+        app.state.message_buffer = MessageBuffer(storage) if MESSAGE_BUFFER_ENABLED else None
+        worker = build_worker(storage) if EMBEDDED_WORKER else None
+        worker_task = asyncio.create_task(worker.run()) if worker else None
         yield {"storage": storage}
-        await renderer.stop()
+        if app.state.message_buffer is not None:
+            await app.state.message_buffer.close()
+        await media_store.close()
+        if worker:
+            await worker.stop()
+            worker_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await worker_task
         
 
 app = whatsapp_app.get_app(lifespan=lifespan)
@@ -165,6 +201,18 @@ async def validation_exception_handler(request, exc: Exception):
         content={"message": str(exc)},
     )
 
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_prometheus())
+
+@app.get("/metrics/pipeline")
+async def pipeline_metrics(hours: float = 24):
+    """p50/p95 per generation step: recent runs in this process and all runs persisted in the window."""
+    return {
+        "process": live_percentiles(),
+        "persisted": await (await get_storage()).step_run_summary(hours),
+    }
+
 if __name__ == "__main__":
     whatsapp_app.serve(app="main:app", port=8000, reload=True, host="0.0.0.0")
 
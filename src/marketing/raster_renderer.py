@@ -0,0 +1,187 @@
+import asyncio
+import os
+from io import BytesIO
+from pathlib import Path
+
+import httpx
+
+from src.utils import COLORS
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:  # Pillow es opcional (extra `raster`)
+    Image = ImageDraw = ImageFont = None
+
+RENDER_RASTER_TEMPLATES = {
+    name.strip() for name in os.getenv("RENDER_RASTER_TEMPLATES", "post").split(",") if name.strip()
+}
+RENDER_FONT_PATH = os.getenv("RENDER_FONT_PATH")
+RENDER_FONT_BOLD_PATH = os.getenv("RENDER_FONT_BOLD_PATH")
+
+_FONT_CANDIDATES = {
+    "regular": [
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+        "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+        "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+    ],
+    "bold": [
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+        "/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf",
+        "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
+    ],
+}
+
+
+class UnsupportedTemplate(Exception):
+    """La plantilla (o sus parámetros) no se puede componer sin navegador."""
+
+    pass
+
+
+def resolve_accent(accent: str | None) -> tuple[int, int, int] | None:
+    """Convierte '#RRGGBB' o un nombre de `COLORS` a RGB; None si no se reconoce."""
+    if not accent:
+        return None
+    value = accent.strip()
+    value = COLORS.get(value.lower(), value)
+    if value.startswith("#") and len(value) == 7:
+        try:
+            return tuple(int(value[i : i + 2], 16) for i in (1, 3, 5))
+        except ValueError:
+            return None
+    return None
+
+
+class RasterRenderer:
+    """
+    Backend sin navegador para las plantillas de layout fijo.
+    Replica post.html.j2 (fondo cover, capa oscura, tres bloques de texto centrados)
+    directamente con Pillow, en un thread para no bloquear el event loop.
+    """
+
+    def __init__(self, templates: set[str] = RENDER_RASTER_TEMPLATES):
+        self.templates = templates
+        self._layouts = {"post": self._compose_post}
+        self._fonts: dict[tuple[str, int], "ImageFont.FreeTypeFont"] = {}
+
+    def supports(self, template_name: str) -> bool:
+        return Image is not None and template_name in self.templates and template_name in self._layouts
+
+    async def render_to_png(self, template_name: str, params: dict) -> BytesIO:
+        if not self.supports(template_name):
+            raise UnsupportedTemplate(template_name)
+        background = await self._load_background(params)
+        return await asyncio.to_thread(self._layouts[template_name], params, background)
+
+    async def _load_background(self, params: dict) -> bytes | None:
+        if params.get("image_bytes"):
+            return params["image_bytes"]
+        url = params.get("image")
+        if not url:
+            return None
+        try:
+            async with httpx.AsyncClient(timeout=30.0) as client:
+                resp = await client.get(url)
+                resp.raise_for_status()
+                return resp.content
+        except httpx.HTTPError as e:
+            raise UnsupportedTemplate(f"No se pudo descargar el fondo {url}: {e}")
+
+    def _font(self, weight: str, size: int):
+        key = (weight, size)
+        if key not in self._fonts:
+            configured = RENDER_FONT_BOLD_PATH if weight == "bold" else RENDER_FONT_PATH
+            candidates = [configured] if configured else []
+            candidates += _FONT_CANDIDATES[weight]
+            path = next((c for c in candidates if c and Path(c).exists()), None)
+            self._fonts[key] = (
+                ImageFont.truetype(path, size) if path else ImageFont.load_default(size=size)
+            )
+        return self._fonts[key]
+
+    @staticmethod
+    def _wrap(draw, text: str, font, max_width: int) -> list[str]:
+        lines: list[str] = []
+        for paragraph in text.strip().splitlines() or [""]:
+            line = ""
+            for word in paragraph.split():
+                candidate = f"{line} {word}".strip()
+                if not line or draw.textlength(candidate, font=font) <= max_width:
+                    line = candidate
+                else:
+                    lines.append(line)
+                    line = word
+            lines.append(line)
+        return lines
+
+    def _compose_post(self, params: dict, background: bytes | None) -> BytesIO:
+        width, height = 1080, 1920
+        canvas = Image.new("RGB", (width, height), (0, 0, 0))
+
+        # Fondo: equivalente a bg-cover bg-center
+        if background:
+            try:
+                bg = Image.open(BytesIO(background)).convert("RGB")
+            except Exception as e:
+                raise UnsupportedTemplate(f"Fondo ilegible: {e}")
+            scale = max(width / bg.width, height / bg.height)
+            bg = bg.resize((round(bg.width * scale), round(bg.height * scale)), Image.LANCZOS)
+            left, top = (bg.width - width) // 2, (bg.height - height) // 2
+            canvas.paste(bg.crop((left, top, left + width, top + height)))
+
+        # Capa oscura: bg-black/40
+        canvas = Image.alpha_composite(
+            canvas.convert("RGBA"), Image.new("RGBA", (width, height), (0, 0, 0, 102))
+        )
+        draw = ImageDraw.Draw(canvas)
+        accent = resolve_accent(params.get("accent_color"))
+
+        # (texto, fuente, line-height, padding x, padding y, radio, margen inferior)
+        blocks = [
+            (params.get("main_text") or "", self._font("bold", 60), 60, 24, 16, 16, 24),
+            (params.get("secondary_text") or "", self._font("regular", 30), 36, 20, 12, 12, 32),
+            ("Destacado", self._font("bold", 18), 28, 24, 12, None, 0),
+        ]
+        max_text_width = width - 2 * 40
+
+        laid_out = []
+        total_height = 0
+        for text, font, line_height, pad_x, pad_y, radius, margin in blocks:
+            lines = self._wrap(draw, text, font, max_text_width - 2 * pad_x)
+            text_width = max((draw.textlength(line, font=font) for line in lines), default=0)
+            box_w = int(text_width) + 2 * pad_x
+            box_h = len(lines) * line_height + 2 * pad_y
+            laid_out.append((lines, font, line_height, pad_y, radius, margin, box_w, box_h))
+            total_height += box_h + margin
+
+        y = (height - total_height) // 2
+        for lines, font, line_height, pad_y, radius, margin, box_w, box_h in laid_out:
+            x = (width - box_w) // 2
+            if accent:
+                draw.rounded_rectangle(
+                    (x, y, x + box_w, y + box_h),
+                    radius=box_h // 2 if radius is None else radius,
+                    fill=accent,
+                )
+            line_y = y + pad_y
+            for line in lines:
+                draw.text(
+                    (width // 2, line_y + line_height // 2),
+                    line,
+                    font=font,
+                    fill=(255, 255, 255),
+                    anchor="mm",
+                )
+                line_y += line_height
+            y += box_h + margin
+
+        # Esquinas rounded-xl sobre fondo negro, como la captura del div #content
+        mask = Image.new("L", (width, height), 0)
+        ImageDraw.Draw(mask).rounded_rectangle((0, 0, width - 1, height - 1), radius=12, fill=255)
+        output = Image.new("RGB", (width, height), (0, 0, 0))
+        output.paste(canvas.convert("RGB"), mask=mask)
+
+        buffer = BytesIO()
+        output.save(buffer, format="PNG", compress_level=3)
+        buffer.seek(0)
+        return buffer
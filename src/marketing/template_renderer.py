@@ -1,10 +1,123 @@
+import asyncio
+import os
+import shutil
+from contextlib import asynccontextmanager
 from pathlib import Path
 from io import BytesIO
+from typing import AsyncIterator
 from jinja2 import Environment, FileSystemLoader, select_autoescape, TemplateNotFound
-from playwright.async_api import async_playwright, Browser
+from playwright.async_api import async_playwright, Browser, Page, Error as PlaywrightError
+
+from .raster_renderer import RasterRenderer, UnsupportedTemplate
+
+RENDER_POOL_SIZE = int(os.getenv("RENDER_POOL_SIZE", "3"))
+RENDER_PAGE_MAX_USES = int(os.getenv("RENDER_PAGE_MAX_USES", "50"))
+RENDER_HEALTHCHECK_TIMEOUT = float(os.getenv("RENDER_HEALTHCHECK_TIMEOUT", "2"))
+RENDER_CSS_MODE = os.getenv("RENDER_CSS_MODE", "precompiled")  # precompiled | startup | cdn
+RENDER_READY_TIMEOUT = float(os.getenv("RENDER_READY_TIMEOUT", "5"))
+TAILWIND_CLI = os.getenv("TAILWIND_CLI", "tailwindcss")
+VIEWPORT = {"width": 1080, "height": 1920}
+
+# Señal de "listo": fuentes cargadas y fondos (data-bg) decodificados.
+READY_JS = """
+async () => {
+    await document.fonts.ready;
+    const backgrounds = Array.from(document.querySelectorAll('[data-bg]'), (el) => {
+        const img = new Image();
+        img.src = el.dataset.bg;
+        return img.decode().catch(() => null);
+    });
+    await Promise.all(backgrounds);
+}
+"""
+
+
+class PagePool:
+    """
+    Pool acotado de tabs precalentadas.
+    - Nunca hay más de `size` tabs abiertas: los renders concurrentes esperan turno.
+    - Cada tab se revisa antes de entregarse y se recicla tras `max_uses` renders
+      o cuando Chromium la reporta caída.
+    """
+
+    def __init__(self, browser: Browser, size: int = RENDER_POOL_SIZE, max_uses: int = RENDER_PAGE_MAX_USES):
+        self._browser = browser
+        self._size = max(1, size)
+        self._max_uses = max(1, max_uses)
+        self._slots = asyncio.Semaphore(self._size)
+        self._idle: asyncio.Queue[Page] = asyncio.Queue()
+        self._uses: dict[Page, int] = {}
+        self._crashed: set[Page] = set()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    async def warm(self):
+        """Abre las tabs por adelantado para que el primer render no pague el costo."""
+        while len(self._uses) < self._size:
+            self._idle.put_nowait(await self._new_page())
+
+    async def close(self):
+        for page in list(self._uses):
+            await self._discard(page)
+
+    @asynccontextmanager
+    async def page(self) -> AsyncIterator[Page]:
+        """Presta una tab del pool y la devuelve (o la recicla) al terminar."""
+        async with self._slots:
+            page = await self._checkout()
+            broken = False
+            try:
+                yield page
+            except PlaywrightError:
+                broken = True
+                raise
+            finally:
+                await self._checkin(page, broken)
+
+    async def _new_page(self) -> Page:
+        page = await self._browser.new_page(viewport=VIEWPORT)
+        page.on("crash", lambda p: self._crashed.add(p))
+        self._uses[page] = 0
+        return page
+
+    async def _healthy(self, page: Page) -> bool:
+        if page.is_closed() or page in self._crashed:
+            return False
+        try:
+            await asyncio.wait_for(page.evaluate("1"), timeout=RENDER_HEALTHCHECK_TIMEOUT)
+            return True
+        except (PlaywrightError, asyncio.TimeoutError):
+            return False
+
+    async def _checkout(self) -> Page:
+        while not self._idle.empty():
+            page = self._idle.get_nowait()
+            if await self._healthy(page):
+                return page
+            await self._discard(page)
+        return await self._new_page()
+
+    async def _checkin(self, page: Page, broken: bool):
+        self._uses[page] = self._uses.get(page, 0) + 1
+        if broken or page.is_closed() or page in self._crashed or self._uses[page] >= self._max_uses:
+            await self._discard(page)
+            return
+        self._idle.put_nowait(page)
+
+    async def _discard(self, page: Page):
+        self._uses.pop(page, None)
+        self._crashed.discard(page)
+        try:
+            if not page.is_closed():
+                await page.close()
+        except PlaywrightError:
+            pass
+
 
 class RenderService:
-    def __init__(self, templates_dir: str = "templates"):
+    def __init__(self, templates_dir: str = "templates", pool_size: int = RENDER_POOL_SIZE):
         self.templates_dir = Path(templates_dir)
         self.env = Environment(
             loader=FileSystemLoader(str(self.templates_dir)),
@@ -12,29 +125,106 @@ class RenderService:
         )
         self.playwright = None
         self.browser: Browser | None = None
+        self.pool: PagePool | None = None
+        self.pool_size = pool_size
+        self.css_mode = RENDER_CSS_MODE
+        self._stylesheets: dict[str, str | None] = {}
+        self.raster = RasterRenderer()
+        self._start_lock = asyncio.Lock()
 
     async def start(self):
-        """Levanta Playwright y un browser (Chromium)."""
-        self.playwright = await async_playwright().start()
-        self.browser = await self.playwright.chromium.launch(
-            args=["--allow-file-access-from-files"]
-        )
-        print("✅ Browser iniciado con soporte file://")
+        """Levanta Playwright, un browser (Chromium) y precalienta el pool de tabs."""
+        async with self._start_lock:
+            if self.browser:
+                return
+            self.playwright = await async_playwright().start()
+            self.browser = await self.playwright.chromium.launch(
+                args=["--allow-file-access-from-files"]
+            )
+            self.pool = PagePool(self.browser, size=self.pool_size)
+            await self.pool.warm()
+            await self.compile_stylesheets()
+            print(f"✅ Browser iniciado con soporte file:// ({self.pool.size} tabs)")
 
     async def stop(self):
-        """Cierra browser y Playwright."""
+        """Cierra el pool, el browser y Playwright."""
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
         if self.browser:
             await self.browser.close()
+            self.browser = None
         if self.playwright:
             await self.playwright.stop()
+            self.playwright = None
         print("🛑 Browser cerrado")
 
+    async def compile_stylesheets(self):
+        """Carga (o compila, en modo `startup`) el CSS de todas las plantillas."""
+        for template_path in self.templates_dir.glob("*.html.j2"):
+            await self._load_stylesheet(template_path.name.removesuffix(".html.j2"))
+
+    async def _load_stylesheet(self, template_name: str) -> str | None:
+        """
+        Devuelve el CSS a inyectar inline en la plantilla, o None para usar el CDN.
+        - precompiled: lee `<plantilla>.css` generado en build.
+        - startup: compila con el CLI de Tailwind al arrancar; si no está, usa el precompilado.
+        - cdn: comportamiento anterior (Tailwind en runtime).
+        """
+        if template_name in self._stylesheets:
+            return self._stylesheets[template_name]
+
+        stylesheet = None
+        if self.css_mode != "cdn":
+            if self.css_mode == "startup":
+                stylesheet = await self._compile_with_cli(template_name)
+            css_path = self.templates_dir / f"{template_name}.css"
+            if stylesheet is None and css_path.exists():
+                stylesheet = css_path.read_text(encoding="utf-8")
+        if stylesheet is None and self.css_mode != "cdn":
+            print(f"⚠️ Sin CSS precompilado para '{template_name}', se usará el CDN de Tailwind")
+
+        self._stylesheets[template_name] = stylesheet
+        return stylesheet
+
+    async def _compile_with_cli(self, template_name: str) -> str | None:
+        cli = shutil.which(TAILWIND_CLI)
+        if not cli:
+            return None
+        template_path = self.templates_dir / f"{template_name}.html.j2"
+        proc = await asyncio.create_subprocess_exec(
+            cli, "--content", str(template_path), "--minify",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            print(f"⚠️ Tailwind CLI falló para '{template_name}': {stderr.decode(errors='replace')}")
+            return None
+        return stdout.decode("utf-8")
+
+    async def _wait_until_ready(self, page: Page):
+        """Espera fuentes e imágenes de fondo en lugar de un sleep fijo."""
+        try:
+            await asyncio.wait_for(page.evaluate(READY_JS), timeout=RENDER_READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("⚠️ Timeout esperando fuentes/imágenes, se captura igual")
+
     async def render_to_png(self, template_name: str, params: dict) -> BytesIO:
         """
         Renderiza una plantilla Jinja2 a PNG en memoria.
-        - Usa un tab nuevo por tarea concurrente.
+        - Las plantillas soportadas por el backend raster se componen sin Chromium;
+          si no puede con ellas (o falta Pillow) se cae a Playwright.
+        - Usa una tab prestada del pool; la concurrencia queda limitada a su tamaño.
+        - Con CSS inline la captura ocurre en cuanto el DOM, las fuentes y el fondo están listos.
         - Captura solo el div con id="content".
         """
+        if self.raster.supports(template_name):
+            try:
+                return await self.raster.render_to_png(template_name, params)
+            except UnsupportedTemplate as e:
+                print(f"⚠️ Raster no soporta '{template_name}' ({e}), usando Playwright")
+
         if not self.browser:
             await self.start()
 
@@ -44,13 +234,16 @@ class RenderService:
         except TemplateNotFound:
             raise ValueError(f"Template '{template_file}' no encontrado")
 
-        html = template.render(**params)
+        stylesheet = await self._load_stylesheet(template_name)
+        html = template.render(**{**params, "stylesheet": stylesheet})
 
-        # Cada tarea crea su propia tab (aislamiento concurrente)
-        page = await self.browser.new_page(viewport={"width": 1080, "height": 1920})
-        try:
-            await page.set_content(html, wait_until="networkidle")
-            await page.wait_for_timeout(1000)  # esperar CDN de Tailwind
+        async with self.pool.page() as page:
+            if stylesheet:
+                await page.set_content(html, wait_until="domcontentloaded")
+                await self._wait_until_ready(page)
+            else:
+                await page.set_content(html, wait_until="networkidle")
+                await page.wait_for_timeout(1000)  # esperar CDN de Tailwind
 
             element = await page.query_selector("#content")
             if not element:
@@ -58,5 +251,3 @@ class RenderService:
 
             screenshot_bytes = await element.screenshot(type="png")
             return BytesIO(screenshot_bytes)
-        finally:
-            await page.close()
@@ -0,0 +1,98 @@
+"""
+In-process read-through cache of brands rows keyed by user phone.
+
+Entries expire after a TTL and the cache is bounded (LRU). Writes through
+`PostgresStorage.upsert_brand` invalidate the local entry; with
+BRAND_CACHE_NOTIFY enabled they also NOTIFY the `brand_cache` channel so other
+replicas (and the separate worker process) drop theirs. NOTIFY is on by default
+when the worker does not run embedded in the web process. A process that should
+listen but cannot reads brands straight from Postgres instead of caching them.
+"""
+from __future__ import annotations
+
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+import asyncpg
+
+from .metrics import counter
+
+BRAND_CACHE_TTL_SECONDS = float(os.getenv("BRAND_CACHE_TTL_SECONDS", "300"))
+BRAND_CACHE_MAX_ENTRIES = int(os.getenv("BRAND_CACHE_MAX_ENTRIES", "2048"))
+# Same switch as main.py: a standalone worker must see brand edits made through the app.
+_EMBEDDED_WORKER = os.getenv("EMBEDDED_WORKER", "true").lower() in ("1", "true", "yes")
+BRAND_CACHE_NOTIFY = os.getenv("BRAND_CACHE_NOTIFY", "false" if _EMBEDDED_WORKER else "true").lower() == "true"
+# LISTEN needs a session, so it cannot go through a transaction-mode pooler.
+BRAND_CACHE_NOTIFY_URL = os.getenv("BRAND_CACHE_NOTIFY_URL")
+BRAND_CACHE_CHANNEL = "brand_cache"
+
+brand_cache_hits = counter("brand_cache_hits_total", "Brand lookups served from memory")
+brand_cache_misses = counter("brand_cache_misses_total", "Brand lookups that went to Postgres")
+
+
+class BrandCache:
+    def __init__(self, ttl_seconds: float = BRAND_CACHE_TTL_SECONDS, max_entries: int = BRAND_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # phone -> (brands row or None, expires_at)
+        self._entries: OrderedDict[str, tuple[dict | None, float]] = OrderedDict()
+        self._listener: asyncpg.Connection | None = None
+
+    async def get(self, phone: str, load: Callable[[str], Awaitable[dict | None]]) -> dict | None:
+        entry = self._entries.get(phone)
+        if entry and entry[1] > time.monotonic():
+            self._entries.move_to_end(phone)
+            brand_cache_hits.inc()
+            return entry[0]
+
+        brand_cache_misses.inc()
+        row = await load(phone)
+        self._entries[phone] = (row, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(phone)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return row
+
+    def invalidate(self, phone: str) -> None:
+        self._entries.pop(phone, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def bypass(self) -> None:
+        """Stop caching: without invalidations, every lookup goes to Postgres."""
+        self.ttl_seconds = 0
+        self.clear()
+
+    async def listen(self, dsn: str, pooled: bool = False) -> None:
+        """Drop entries when another replica NOTIFYs a change on the brand_cache channel."""
+        if pooled and not BRAND_CACHE_NOTIFY_URL:
+            print("Brand cache: LISTEN needs BRAND_CACHE_NOTIFY_URL behind a pooler, caching disabled")
+            self.bypass()
+            return
+        try:
+            self._listener = await asyncpg.connect(BRAND_CACHE_NOTIFY_URL or dsn, statement_cache_size=0)
+            await self._listener.add_listener(BRAND_CACHE_CHANNEL, self._on_notify)
+        except Exception as e:
+            print(f"Brand cache could not LISTEN ({e}), caching disabled")
+            await self.close()
+            self.bypass()
+            return
+        self._listener.add_termination_listener(self._on_listener_lost)
+        print(f"Brand cache listening on '{BRAND_CACHE_CHANNEL}'")
+
+    async def close(self) -> None:
+        if self._listener is not None and not self._listener.is_closed():
+            await self._listener.close()
+        self._listener = None
+
+    def _on_notify(self, conn, pid, channel, phone: str) -> None:
+        self.invalidate(phone)
+
+    def _on_listener_lost(self, conn) -> None:
+        # Notifications may have been missed and will not arrive any more
+        print("Brand cache listener connection lost, caching disabled")
+        self.bypass()
+        self._listener = None
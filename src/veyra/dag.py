@@ -0,0 +1,87 @@
+"""
+Tiny dependency-graph scheduler for the generation flow.
+
+Each node runs once all of its dependencies are done, so independent branches
+run concurrently. Nodes already marked done (e.g. by an earlier, interrupted
+run) are skipped; when a node fails its descendants are left pending, so the
+next run only redoes the failed subtree.
+"""
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+@dataclass
+class Node:
+    name: str
+    deps: list[str] = field(default_factory=list)
+
+
+def validate(nodes: list[Node]) -> None:
+    """Raise ValueError on unknown dependencies or cycles."""
+    names = {node.name for node in nodes}
+    for node in nodes:
+        unknown = set(node.deps) - names
+        if unknown:
+            raise ValueError(f"Node {node.name} depends on unknown nodes {sorted(unknown)}")
+    deps = {node.name: set(node.deps) for node in nodes}
+    resolved: set[str] = set()
+    while deps:
+        ready = [name for name, d in deps.items() if d <= resolved]
+        if not ready:
+            raise ValueError(f"Cycle between nodes {sorted(deps)}")
+        for name in ready:
+            resolved.add(name)
+            del deps[name]
+
+
+async def run_dag(
+    nodes: list[Node],
+    status: dict[str, str],
+    run: Callable[[Node], Awaitable[None]],
+) -> dict[str, BaseException]:
+    """
+    Run every node that is not DONE in `status` as soon as its dependencies are.
+    `status` is updated in place; returns the errors of the nodes that failed.
+    """
+    validate(nodes)
+    running: dict[asyncio.Task, Node] = {}
+    errors: dict[str, BaseException] = {}
+
+    def ready() -> list[Node]:
+        busy = {node.name for node in running.values()}
+        return [
+            node for node in nodes
+            if status.get(node.name) != DONE
+            and node.name not in errors
+            and node.name not in busy
+            and all(status.get(dep) == DONE for dep in node.deps)
+        ]
+
+    try:
+        while True:
+            for node in ready():
+                status[node.name] = RUNNING
+                running[asyncio.create_task(run(node))] = node
+            if not running:
+                break
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                node = running.pop(task)
+                error = task.exception()
+                if error is None:
+                    status[node.name] = DONE
+                else:
+                    status[node.name] = FAILED
+                    errors[node.name] = error
+    finally:
+        for task in running:
+            task.cancel()
+    return errors
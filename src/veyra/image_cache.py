@@ -0,0 +1,160 @@
+import hashlib
+import os
+import time
+import unicodedata
+from collections import OrderedDict
+
+import asyncpg
+
+from .metrics import counter
+from .s3 import download_from_s3
+
+IMAGE_CACHE_TTL_SECONDS = int(os.getenv("IMAGE_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+IMAGE_CACHE_MEMORY_MB = int(os.getenv("IMAGE_CACHE_MEMORY_MB", "64"))
+IMAGE_CACHE_MAX_ROWS = int(os.getenv("IMAGE_CACHE_MAX_ROWS", "20000"))
+IMAGE_CACHE_EVICT_EVERY = int(os.getenv("IMAGE_CACHE_EVICT_EVERY", "50"))
+
+cache_hits = counter("image_cache_hits_total", "Generated-image cache hits, by layer")
+cache_misses = counter("image_cache_misses_total", "Generated-image cache misses")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Collapse whitespace/indentation and unicode forms so equivalent prompts share a key."""
+    return " ".join(unicodedata.normalize("NFKC", prompt).split())
+
+
+def cache_key(engine: str, model: str, prompt: str, resolution: str) -> str:
+    raw = "\x1f".join([engine, model, normalize_prompt(prompt), resolution])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    """
+    Two-level cache of generated images: a byte-bounded in-process LRU in front of
+    the `image_cache` table. Postgres only stores the S3 URL/key; on a table hit
+    the bytes are read back from the bucket instead of calling the model again.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: int = IMAGE_CACHE_TTL_SECONDS,
+        memory_bytes: int = IMAGE_CACHE_MEMORY_MB * 1024 * 1024,
+        max_rows: int = IMAGE_CACHE_MAX_ROWS,
+    ):
+        self.pool: asyncpg.Pool | None = None
+        self.ttl_seconds = ttl_seconds
+        self.memory_bytes = memory_bytes
+        self.max_rows = max_rows
+        # key -> (image_url, image_bytes, expires_at)
+        self._memory: OrderedDict[str, tuple[str, bytes, float]] = OrderedDict()
+        self._memory_used = 0
+        self._puts = 0
+
+    def attach(self, pool: asyncpg.Pool | None) -> None:
+        self.pool = pool
+
+    async def get(self, engine: str, model: str, prompt: str, resolution: str) -> tuple[str, bytes] | None:
+        key = cache_key(engine, model, prompt, resolution)
+
+        entry = self._memory.get(key)
+        if entry and entry[2] > time.monotonic():
+            self._memory.move_to_end(key)
+            cache_hits.inc(layer="memory")
+            return entry[0], entry[1]
+        if entry:
+            self._forget(key)
+
+        if self.pool is not None:
+            try:
+                row = await self.pool.fetchrow(
+                    """
+                    UPDATE image_cache SET last_hit_at = NOW()
+                    WHERE cache_key = $1
+                      AND created_at > NOW() - make_interval(secs => $2)
+                    RETURNING image_url, object_key
+                    """,
+                    key,
+                    self.ttl_seconds,
+                )
+                if row:
+                    image_bytes = await download_from_s3(row["object_key"])
+                    self._remember(key, row["image_url"], image_bytes)
+                    cache_hits.inc(layer="postgres")
+                    return row["image_url"], image_bytes
+            except Exception as e:
+                print(f"Image cache lookup failed: {e}")
+
+        cache_misses.inc()
+        return None
+
+    async def put(
+        self, engine: str, model: str, prompt: str, resolution: str, image_url: str, image_bytes: bytes
+    ) -> None:
+        key = cache_key(engine, model, prompt, resolution)
+        self._remember(key, image_url, image_bytes)
+        if self.pool is None:
+            return
+        try:
+            await self.pool.execute(
+                """
+                INSERT INTO image_cache
+                    (cache_key, engine, model, prompt, resolution, image_url, object_key, size_bytes)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    image_url = EXCLUDED.image_url,
+                    object_key = EXCLUDED.object_key,
+                    size_bytes = EXCLUDED.size_bytes,
+                    created_at = NOW(),
+                    last_hit_at = NOW()
+                """,
+                key,
+                engine,
+                model,
+                normalize_prompt(prompt),
+                resolution,
+                image_url,
+                image_url.rsplit("/", 1)[-1],
+                len(image_bytes),
+            )
+            self._puts += 1
+            if self._puts % IMAGE_CACHE_EVICT_EVERY == 0:
+                await self.evict()
+        except Exception as e:
+            print(f"Image cache store failed: {e}")
+
+    async def evict(self) -> None:
+        """Drop expired rows, then the least recently hit rows above `max_rows`."""
+        if self.pool is None:
+            return
+        await self.pool.execute(
+            "DELETE FROM image_cache WHERE created_at < NOW() - make_interval(secs => $1)",
+            self.ttl_seconds,
+        )
+        await self.pool.execute(
+            """
+            DELETE FROM image_cache WHERE cache_key IN (
+                SELECT cache_key FROM image_cache
+                ORDER BY last_hit_at DESC
+                OFFSET $1
+            )
+            """,
+            self.max_rows,
+        )
+
+    def _remember(self, key: str, image_url: str, image_bytes: bytes) -> None:
+        if len(image_bytes) > self.memory_bytes:
+            return
+        self._forget(key)
+        self._memory[key] = (image_url, image_bytes, time.monotonic() + self.ttl_seconds)
+        self._memory_used += len(image_bytes)
+        while self._memory_used > self.memory_bytes:
+            _, (_, evicted, _) = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted)
+
+    def _forget(self, key: str) -> None:
+        entry = self._memory.pop(key, None)
+        if entry:
+            self._memory_used -= len(entry[1])
+
+
+image_cache = ImageCache()
@@ -1,34 +1,41 @@
+import asyncio
 import base64
 from typing import TypedDict
-import uuid
 import os
-import aioboto3
 from openai import AsyncOpenAI
 from google import genai
 from google.genai.types import GenerateImagesConfigDict
 
+from .image_cache import image_cache
+from .metrics import histogram, timed
+from .s3 import upload_to_s3
+from .step_metrics import record_image
 
-BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
-ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
-REGION_NAME = os.getenv("REGION_NAME") or "us-east-1"
-ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
-SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-print(
-    "S3_BUCKET_NAME", BUCKET_NAME,
-    "S3_ENDPOINT_URL", ENDPOINT_URL,
-    "REGION_NAME", REGION_NAME,
-    "AWS_ACCESS_KEY", ACCESS_KEY,
-    "AWS_SECRET_ACCESS_KEY", SECRET_KEY,
-)
 
 openai_client = AsyncOpenAI()
 gemini_client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
 
+# Max concurrent requests per engine, to stay under provider rate limits.
+IMAGE_GEN_CONCURRENCY = {
+    "openai": int(os.getenv("IMAGE_GEN_CONCURRENCY_OPENAI", "4")),
+    "gemini": int(os.getenv("IMAGE_GEN_CONCURRENCY_GEMINI", "4")),
+}
+_engine_slots = {engine: asyncio.Semaphore(limit) for engine, limit in IMAGE_GEN_CONCURRENCY.items()}
+
+IMAGE_MODELS = {
+    "openai": "gpt-image-1",
+    "gemini": "imagen-4.0-fast-generate-001",
+}
+
+image_gen_seconds = histogram(
+    "image_generation_seconds", "Time spent waiting on the image model, per engine"
+)
+
 
 async def generate_openai(prompt: str, resolution: str = "1024x1024") -> bytes:
     """Generate image bytes using OpenAI DALL·E (gpt-image-1)."""
     response = await openai_client.images.generate(
-        model="gpt-image-1",
+        model=IMAGE_MODELS["openai"],
         prompt=prompt,
         size=resolution,
         n=1,
@@ -49,8 +56,8 @@ async def generate_gemini(prompt: str, resolution: str = "1024x1024") -> bytes:
     #     './image.png'
     # , 'rb') as f:
     #     return f.read()
-    response = gemini_client.models.generate_images(
-        model="imagen-4.0-fast-generate-001",
+    response = await gemini_client.aio.models.generate_images(
+        model=IMAGE_MODELS["gemini"],
         prompt=prompt,
         config=GenerateImagesConfigDict(number_of_images=1),
     )
@@ -59,28 +66,6 @@ async def generate_gemini(prompt: str, resolution: str = "1024x1024") -> bytes:
     return response.generated_images[0].image.image_bytes
 
 
-async def upload_to_s3(image_bytes: bytes, ext: str = "png") -> str:
-    filename = f"{uuid.uuid4()}.{ext}"
-    session = aioboto3.Session()
-
-    async with session.resource(
-        "s3",
-        region_name=REGION_NAME,
-        endpoint_url=f"{ENDPOINT_URL}/s3",
-        aws_access_key_id=ACCESS_KEY,
-        aws_secret_access_key=SECRET_KEY,
-    ) as s3:
-        bucket = await s3.Bucket(BUCKET_NAME)
-
-        obj = await bucket.Object(filename)
-        await obj.put(
-            Body=image_bytes,
-            ContentType=f"image/{ext}",
-        )
-
-    return f"{ENDPOINT_URL}/object/public/{BUCKET_NAME}/{filename}"
-
-
 class ImageGenerationOutput(TypedDict):
     image_url: str
     image_bytes: bytes
@@ -91,19 +76,37 @@ async def generate_image(
     engine: str = "gemini",
     resolution: str = "1024x1024",
 ) -> ImageGenerationOutput:
-    """Generate an image with OpenAI or Gemini, upload to S3, return public URL."""
+    """
+    Generate an image with OpenAI or Gemini, upload to S3, return public URL.
+    Prompts already generated for the same engine/model/resolution are served from the cache.
+    """
     try:
-        if engine == "openai":
-            image_bytes = await generate_openai(prompt, resolution)
-        elif engine == "gemini":
-            image_bytes = await generate_gemini(prompt + "\n resolution: " + resolution)
-        else:
+        if engine not in _engine_slots:
             raise ValueError(f"Unknown engine: {engine}")
-
-        return {"image_url": await upload_to_s3(image_bytes), "image_bytes": image_bytes}
+        model = IMAGE_MODELS[engine]
+        cached = await image_cache.get(engine, model, prompt, resolution)
+        if cached:
+            image_url, image_bytes = cached
+            record_image("cached")
+            return {"image_url": image_url, "image_bytes": image_bytes}
+
+        async with _engine_slots[engine]:
+            with timed(image_gen_seconds, engine=engine):
+                if engine == "openai":
+                    image_bytes = await generate_openai(prompt, resolution)
+                else:
+                    image_bytes = await generate_gemini(prompt + "\n resolution: " + resolution)
+
+        image_url = await upload_to_s3(image_bytes)
+        await image_cache.put(engine, model, prompt, resolution, image_url, image_bytes)
+        record_image("generated")
+        return {"image_url": image_url, "image_bytes": image_bytes}
     except Exception as e:
         print(f"Error generating image: {e}")
         # Return a default image in case of failure
+        # (content-addressed, so it is only stored once no matter how often this fires)
         with open('./image.jpg', 'rb') as f:
             image_bytes = f.read()
-        return {"image_url": await upload_to_s3(image_bytes), "image_bytes": image_bytes}
+        url = await upload_to_s3(image_bytes, ext="jpg", content_type="image/jpeg")
+        record_image("fallback")
+        return {"image_url": url, "image_bytes": image_bytes}
@@ -0,0 +1,296 @@
+"""
+Durable job queue on Postgres.
+
+Jobs are leased with `SELECT ... FOR UPDATE SKIP LOCKED`, kept alive by heartbeats
+while they run, and become visible again when a lease expires (e.g. the machine
+running them was stopped). Failures are retried with exponential backoff.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import socket
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+
+import asyncpg
+
+from .metrics import counter, histogram
+
+JOB_VISIBILITY_TIMEOUT = float(os.getenv("JOB_VISIBILITY_TIMEOUT", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_BACKOFF_BASE = float(os.getenv("JOB_BACKOFF_BASE", "10"))
+JOB_BACKOFF_MAX = float(os.getenv("JOB_BACKOFF_MAX", "900"))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "2"))
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "1"))
+
+GENERATION_JOB = "generation"
+
+jobs_total = counter("jobs_total", "Jobs finished by workers, by kind and outcome")
+job_queue_wait = histogram("jobs_queue_wait_seconds", "Time from when a job was due to when a worker leased it")
+jobs_deduplicated = counter("jobs_deduplicated_total", "Enqueues that matched a job already queued or running")
+
+JobHandler = Callable[[dict], Awaitable[None]]
+
+
+@dataclass
+class Job:
+    job_id: int
+    kind: str
+    payload: dict
+    status: str
+    attempts: int
+    max_attempts: int
+    run_at: datetime
+    locked_by: str | None = None
+    locked_until: datetime | None = None
+    last_error: str | None = None
+    dedup_key: str | None = None
+    created_at: datetime | None = None
+    updated_at: datetime | None = None
+
+    @classmethod
+    def from_row(cls, row: asyncpg.Record) -> "Job":
+        data = dict(row)
+        if isinstance(data["payload"], str):
+            data["payload"] = json.loads(data["payload"])
+        return cls(**data)
+
+
+def backoff_seconds(attempts: int) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(JOB_BACKOFF_MAX, JOB_BACKOFF_BASE * 2 ** max(0, attempts - 1)))
+
+
+class JobQueue:
+    def __init__(self, pool: asyncpg.Pool, visibility_timeout: float = JOB_VISIBILITY_TIMEOUT):
+        self.pool = pool
+        self.visibility_timeout = visibility_timeout
+
+    async def enqueue(
+        self,
+        kind: str,
+        payload: dict,
+        max_attempts: int = JOB_MAX_ATTEMPTS,
+        dedup_key: str | None = None,
+    ) -> int:
+        """
+        Queue a job. With `dedup_key`, while a job of the same kind and key is still
+        queued or running no new one is created and the existing job id is returned.
+        """
+        job_id = await self.pool.fetchval(
+            """
+            INSERT INTO jobs (kind, payload, max_attempts, dedup_key)
+            VALUES ($1, $2::jsonb, $3, $4)
+            ON CONFLICT (kind, dedup_key) WHERE status IN ('queued', 'running') DO NOTHING
+            RETURNING job_id
+            """,
+            kind,
+            json.dumps(payload),
+            max_attempts,
+            dedup_key,
+        )
+        if job_id is None:
+            job_id = await self.pool.fetchval(
+                """
+                SELECT job_id FROM jobs
+                WHERE kind = $1 AND dedup_key = $2 AND status IN ('queued', 'running')
+                """,
+                kind,
+                dedup_key,
+            )
+            if job_id is None:
+                # It finished in between; queue a fresh one
+                return await self.enqueue(kind, payload, max_attempts, dedup_key)
+            jobs_deduplicated.inc(kind=kind)
+        return job_id
+
+    async def lease(self, kinds: list[str], worker_id: str) -> Job | None:
+        """Claim the next runnable job: queued and due, or running with an expired lease."""
+        row = await self.pool.fetchrow(
+            """
+            UPDATE jobs SET
+                status = 'running',
+                attempts = attempts + 1,
+                locked_by = $2,
+                locked_until = NOW() + make_interval(secs => $3),
+                updated_at = NOW()
+            WHERE job_id = (
+                SELECT job_id FROM jobs
+                WHERE kind = ANY($1::text[])
+                  AND attempts < max_attempts
+                  AND (
+                    (status = 'queued' AND run_at <= NOW())
+                    OR (status = 'running' AND locked_until < NOW())
+                  )
+                ORDER BY run_at
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING *
+            """,
+            kinds,
+            worker_id,
+            self.visibility_timeout,
+        )
+        return Job.from_row(row) if row else None
+
+    async def heartbeat(self, job: Job, worker_id: str) -> bool:
+        """Extend the lease; False means another worker has taken the job over."""
+        result = await self.pool.execute(
+            """
+            UPDATE jobs SET locked_until = NOW() + make_interval(secs => $3), updated_at = NOW()
+            WHERE job_id = $1 AND locked_by = $2 AND status = 'running'
+            """,
+            job.job_id,
+            worker_id,
+            self.visibility_timeout,
+        )
+        return result.endswith(" 1")
+
+    async def complete(self, job: Job, worker_id: str) -> None:
+        await self.pool.execute(
+            """
+            UPDATE jobs SET status = 'done', locked_by = NULL, locked_until = NULL, updated_at = NOW()
+            WHERE job_id = $1 AND locked_by = $2
+            """,
+            job.job_id,
+            worker_id,
+        )
+
+    async def fail(self, job: Job, worker_id: str, error: str) -> None:
+        """Requeue with backoff, or mark failed once attempts are exhausted."""
+        await self.pool.execute(
+            """
+            UPDATE jobs SET
+                status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                run_at = NOW() + make_interval(secs => $3),
+                locked_by = NULL,
+                locked_until = NULL,
+                last_error = $4,
+                updated_at = NOW()
+            WHERE job_id = $1 AND locked_by = $2
+            """,
+            job.job_id,
+            worker_id,
+            backoff_seconds(job.attempts),
+            error[:2000],
+        )
+
+    async def reap(self) -> None:
+        """Mark jobs whose last lease expired with no attempts left as failed."""
+        await self.pool.execute(
+            """
+            UPDATE jobs SET status = 'failed', locked_by = NULL, locked_until = NULL,
+                last_error = COALESCE(last_error, 'lease expired'), updated_at = NOW()
+            WHERE status = 'running' AND locked_until < NOW() AND attempts >= max_attempts
+            """
+        )
+
+
+class Worker:
+    """Pulls jobs for the registered kinds and runs up to `concurrency` of them at once."""
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handlers: dict[str, JobHandler],
+        concurrency: int = WORKER_CONCURRENCY,
+        poll_interval: float = WORKER_POLL_INTERVAL,
+    ):
+        self.queue = queue
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{id(self):x}"
+        self._slots = asyncio.Semaphore(concurrency)
+        self._running: set[asyncio.Task] = set()
+        self._stopping = asyncio.Event()
+        self._idle = asyncio.Event()  # set while run() is not polling
+        self._idle.set()
+        self._last_reap = 0.0
+
+    async def run(self) -> None:
+        print(f"Worker {self.worker_id} polling {list(self.handlers)} x{self.concurrency}")
+        self._idle.clear()
+        try:
+            await self._poll()
+        finally:
+            self._idle.set()
+
+    async def _poll(self) -> None:
+        while not self._stopping.is_set():
+            await self._slots.acquire()
+            if self._stopping.is_set():
+                # A slot freed during shutdown must not lease a job stop() no longer waits for
+                self._slots.release()
+                break
+            try:
+                job = await self.queue.lease(list(self.handlers), self.worker_id)
+            except Exception as e:
+                print(f"Worker lease failed: {e}")
+                job = None
+            if job is None:
+                self._slots.release()
+                await self._reap_if_due()
+                await self._sleep(self.poll_interval)
+                continue
+            task = asyncio.create_task(self._execute(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def stop(self) -> None:
+        """Stop leasing and wait for jobs in progress to finish."""
+        self._stopping.set()
+        # A lease already in flight may still start a job; wait for the loop to exit first
+        await self._idle.wait()
+        while self._running:
+            await asyncio.gather(*list(self._running), return_exceptions=True)
+
+    async def _reap_if_due(self) -> None:
+        now = asyncio.get_running_loop().time()
+        if now - self._last_reap < self.queue.visibility_timeout:
+            return
+        self._last_reap = now
+        try:
+            await self.queue.reap()
+        except Exception as e:
+            print(f"Worker reap failed: {e}")
+
+    async def _sleep(self, seconds: float) -> None:
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _execute(self, job: Job) -> None:
+        job_queue_wait.observe(max(0.0, (datetime.now(timezone.utc) - job.run_at).total_seconds()), kind=job.kind)
+        handler_task = asyncio.create_task(self.handlers[job.kind](job.payload))
+        heartbeat = asyncio.create_task(self._heartbeat(job, handler_task))
+        try:
+            await handler_task
+            await self.queue.complete(job, self.worker_id)
+            jobs_total.inc(kind=job.kind, outcome="done")
+        except asyncio.CancelledError:
+            print(f"Job {job.job_id} lost its lease, abandoning it")
+            jobs_total.inc(kind=job.kind, outcome="lease_lost")
+        except Exception as e:
+            print(f"Job {job.job_id} ({job.kind}) failed on attempt {job.attempts}: {e}")
+            await self.queue.fail(job, self.worker_id, repr(e))
+            jobs_total.inc(kind=job.kind, outcome="failed")
+        finally:
+            heartbeat.cancel()
+            self._slots.release()
+
+    async def _heartbeat(self, job: Job, handler_task: asyncio.Task) -> None:
+        while not handler_task.done():
+            await asyncio.sleep(self.queue.visibility_timeout / 3)
+            try:
+                if not await self.queue.heartbeat(job, self.worker_id):
+                    handler_task.cancel()
+                    return
+            except Exception as e:
+                print(f"Heartbeat for job {job.job_id} failed: {e}")
@@ -7,7 +7,7 @@ from dotenv import load_dotenv
 
 
 
-from .workflow import run_generation_flow
+from .workflow import run_generation_once
 
 from .persistence import PostgresStorage, db_pool
 
@@ -45,5 +45,5 @@ async def run_automarket_agent(request: Request) -> None:
     thread_id = body.get("thread_id", "default")
     logfire.info("Received request for thread {thread_id}", thread_id=thread_id)
     
-    await run_generation_flow(thread_id, storage)
+    await run_generation_once(thread_id, storage)
 
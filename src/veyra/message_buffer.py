@@ -0,0 +1,95 @@
+"""
+Server-side micro-batching for message ingestion.
+
+Messages posted one by one (e.g. each utterance of a voice call) are held for a
+short while and written in a single COPY once the buffer reaches `max_size` or
+the oldest message has waited `max_delay` seconds. A failed write keeps the
+messages and retries on its own, backing off up to MESSAGE_BUFFER_MAX_RETRY_DELAY.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+from contextlib import suppress
+
+from src.whatsapp.model import Message
+
+from .metrics import counter, histogram
+from .persistence import Storage
+
+MESSAGE_BUFFER_ENABLED = os.getenv("MESSAGE_BUFFER_ENABLED", "false").lower() == "true"
+MESSAGE_BUFFER_MAX_SIZE = int(os.getenv("MESSAGE_BUFFER_MAX_SIZE", "200"))
+MESSAGE_BUFFER_MAX_DELAY = float(os.getenv("MESSAGE_BUFFER_MAX_DELAY", "0.5"))
+MESSAGE_BUFFER_MAX_RETRY_DELAY = float(os.getenv("MESSAGE_BUFFER_MAX_RETRY_DELAY", "30"))
+
+messages_ingested = counter("messages_ingested_total", "Messages written to the messages table, by path")
+flush_size = histogram(
+    "message_buffer_flush_size", "Messages written per buffer flush",
+    buckets=(1, 5, 10, 25, 50, 100, 200, 500, 1000),
+)
+
+
+class MessageBuffer:
+    def __init__(
+        self,
+        storage: Storage,
+        max_size: int = MESSAGE_BUFFER_MAX_SIZE,
+        max_delay: float = MESSAGE_BUFFER_MAX_DELAY,
+    ):
+        self.storage = storage
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._pending: list[Message] = []
+        self._lock = asyncio.Lock()
+        self._timer: asyncio.Task | None = None
+        self._retry_delay = max_delay
+
+    async def add(self, message: Message) -> None:
+        self._pending.append(message)
+        if len(self._pending) >= self.max_size:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> int:
+        """Write everything buffered so far; returns how many messages were new."""
+        async with self._lock:
+            if self._timer is not None and self._timer is not asyncio.current_task():
+                self._timer.cancel()
+            self._timer = None
+            batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                inserted = await self.storage.insert_messages(batch)
+            except BaseException as e:
+                # Put them back so the next flush retries them
+                self._pending = batch + self._pending
+                if isinstance(e, Exception):
+                    self._schedule_retry()
+                raise
+            self._retry_delay = self.max_delay
+            flush_size.observe(len(batch))
+            messages_ingested.inc(inserted, path="buffer")
+            return inserted
+
+    async def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._timer
+            self._timer = None
+        await self.flush()
+
+    def _schedule_retry(self) -> None:
+        # Without this, requeued messages would wait for the next add() to arm a timer
+        self._retry_delay = min(MESSAGE_BUFFER_MAX_RETRY_DELAY, max(self._retry_delay, self.max_delay, 0.1) * 2)
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later(self._retry_delay))
+
+    async def _flush_later(self, delay: float | None = None) -> None:
+        await asyncio.sleep(self.max_delay if delay is None else delay)
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Message buffer flush failed ({len(self._pending)} pending): {e}")
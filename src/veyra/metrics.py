@@ -0,0 +1,197 @@
+"""
+In-process metrics for the backend.
+
+Every instrument keeps its own values (so they can be rendered in Prometheus text
+format or queried for percentiles) and mirrors each observation to the
+OpenTelemetry meter, which is exported wherever the OTel SDK is configured.
+"""
+from __future__ import annotations
+
+import asyncio
+import bisect
+import time
+from collections import deque
+from typing import Iterable
+
+from opentelemetry import metrics as otel_metrics
+
+_meter = otel_metrics.get_meter("veyra")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+LabelKey = tuple[tuple[str, str], ...]
+
+
+def _key(labels: dict) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(key: LabelKey, extra: Iterable[tuple[str, str]] = ()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: dict[LabelKey, float] = {}
+        self._otel = _meter.create_counter(name, description=description)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+        self._otel.add(amount, attributes=labels)
+
+    def value(self, **labels) -> float:
+        return self.values.get(_key(labels), 0)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: dict[LabelKey, float] = {}
+        self._otel = _meter.create_up_down_counter(name, description=description)
+
+    def set(self, value: float, **labels) -> None:
+        key = _key(labels)
+        self._otel.add(value - self.values.get(key, 0), attributes=labels)
+        self.values[key] = value
+
+    def value(self, **labels) -> float:
+        return self.values.get(_key(labels), 0)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+
+class Histogram:
+    """Cumulative buckets for export plus a bounded window of recent samples for percentiles."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS, window: int = 2048):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.window = window
+        self._counts: dict[LabelKey, list[int]] = {}
+        self._sums: dict[LabelKey, float] = {}
+        self._recent: dict[LabelKey, deque[float]] = {}
+        self._otel = _meter.create_histogram(name, description=description)
+
+    def observe(self, value: float, **labels) -> None:
+        key = _key(labels)
+        counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] = self._sums.get(key, 0) + value
+        self._recent.setdefault(key, deque(maxlen=self.window)).append(value)
+        self._otel.record(value, attributes=labels)
+
+    def quantile(self, q: float, **labels) -> float | None:
+        recent = self._recent.get(_key(labels))
+        if not recent:
+            return None
+        ordered = sorted(recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def label_sets(self) -> list[dict]:
+        return [dict(key) for key in self._counts]
+
+    def samples(self):
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket", key + (("le", le),), cumulative
+            yield f"{self.name}_sum", key, self._sums[key]
+            yield f"{self.name}_count", key, cumulative
+
+
+_registry: dict[str, Counter | Gauge | Histogram] = {}
+
+
+def _get_or_create(cls, name: str, description: str, **kwargs):
+    instrument = _registry.get(name)
+    if instrument is None:
+        instrument = _registry[name] = cls(name, description, **kwargs)
+    return instrument
+
+
+def counter(name: str, description: str = "") -> Counter:
+    return _get_or_create(Counter, name, description)
+
+
+def gauge(name: str, description: str = "") -> Gauge:
+    return _get_or_create(Gauge, name, description)
+
+
+def histogram(name: str, description: str = "", buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _get_or_create(Histogram, name, description, buckets=buckets)
+
+
+def render_prometheus() -> str:
+    """Render every registered instrument in Prometheus text exposition format."""
+    lines = []
+    for instrument in _registry.values():
+        lines.append(f"# HELP {instrument.name} {instrument.description}")
+        lines.append(f"# TYPE {instrument.name} {instrument.type}")
+        for sample_name, key, value in instrument.samples():
+            lines.append(f"{sample_name}{_fmt_labels(key)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+loop_lag = histogram(
+    "event_loop_lag_seconds",
+    "Delay between when the lag probe should have woken up and when it did",
+)
+loop_blocked = counter(
+    "event_loop_blocked_seconds_total",
+    "Accumulated time the event loop was blocked beyond the lag threshold",
+)
+
+
+async def monitor_event_loop_lag(interval: float = 0.25, threshold: float = 0.1) -> None:
+    """
+    Sleep for `interval` in a loop and record how late each wake-up is.
+    Anything synchronous hogging the loop (e.g. a blocking SDK call) shows up here.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        loop_lag.observe(lag)
+        if lag > threshold:
+            loop_blocked.inc(lag)
+
+
+class timed:
+    """Context manager that observes the elapsed wall time into a histogram."""
+
+    def __init__(self, hist: Histogram, **labels):
+        self.hist = hist
+        self.labels = labels
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self._start
+        self.hist.observe(self.elapsed, **self.labels)
+        return False
@@ -1,8 +1,10 @@
 from __future__ import annotations
+import asyncio
 from dataclasses import dataclass, field
 
 from enum import StrEnum
 from pydantic import BaseModel
+from pydantic.json_schema import SkipJsonSchema
 from typing import List, Optional
 from datetime import datetime
 class CalendarPost(BaseModel):
@@ -20,6 +22,16 @@ class CalendarPost(BaseModel):
     """
     resolution: str
     image_url: Optional[str]
+    # Progress of the images step, persisted with the post but hidden from the
+    # calendar agent's output schema (_run_calendar_step also clears them).
+    render_status: SkipJsonSchema[Optional[str]] = None
+    """
+    generated, rendered, sent or failed:<stage>
+    """
+    media_id: SkipJsonSchema[Optional[str]] = None
+    """
+    WhatsApp media id of the delivered post
+    """
     
 
 class WorkflowStatus(StrEnum):
@@ -33,9 +45,31 @@ class WorkflowStatus(StrEnum):
     PUBLISHED = "published"
     FAILED = "failed"
 
+# Columns update_workflow may write; thread_id, timestamps and version are managed by storage.
+PERSISTED_FIELDS = (
+    "status",
+    "conversation_transcript",
+    "briefing_md",
+    "strategy_and_plan_md",
+    "image_urls",
+    "html_content",
+    "page_url",
+    "calendar_events",
+    "step_status",
+    "image_prompt",
+)
+
+
 @dataclass
 class AutoMarketState:
-    """In-memory representation of the workflow state for a given thread."""
+    """
+    In-memory representation of the workflow state for a given thread.
+    It stays current across steps: saves refresh its version in place.
+
+    Tracks which persisted fields changed since it was loaded or last saved, so
+    storage can write only those. `calendar_events` is compared per post against a
+    snapshot, which also catches posts mutated in place.
+    """
     thread_id: str
     status: WorkflowStatus
     conversation_transcript: str
@@ -47,6 +81,91 @@ class AutoMarketState:
     created_at: datetime | None = None
     updated_at: datetime | None = None
     calendar_events: list[CalendarPost] | None = None
+    step_status: dict[str, str] = field(default_factory=dict)
+    # Master prompt of the images step, kept so a resumed run (and the image cache) reuse it
+    image_prompt: str | None = None
+    version: int = 0
+
+    def __post_init__(self):
+        object.__setattr__(self, "_lock", asyncio.Lock())
+        object.__setattr__(self, "_unloaded", set())
+        self.mark_clean()
+
+    def __setattr__(self, name, value):
+        if name in PERSISTED_FIELDS and "_dirty" in self.__dict__:
+            self._dirty.add(name)
+            self._unloaded.discard(name)
+        object.__setattr__(self, name, value)
+
+    @property
+    def unloaded(self) -> set[str]:
+        """Large columns left out by a lazy load; they read as None until loaded."""
+        return self._unloaded
+
+    def set_loaded(self, name: str, value) -> None:
+        """Fill in a lazily loaded field without marking it dirty."""
+        object.__setattr__(self, name, value)
+        self._unloaded.discard(name)
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        """Serializes saves of this state object."""
+        return self._lock
+
+    def mark_clean(self, calendar_index: int | None = None) -> None:
+        """Forget pending changes (all of them, or only one calendar post that was saved elsewhere)."""
+        if calendar_index is not None:
+            self._calendar_snapshot[calendar_index] = self.calendar_events[calendar_index].model_dump_json()
+            return
+        object.__setattr__(self, "_dirty", set())
+        object.__setattr__(self, "_image_urls_snapshot", list(self.image_urls or []))
+        object.__setattr__(self, "_step_status_snapshot", dict(self.step_status or {}))
+        object.__setattr__(
+            self, "_calendar_snapshot",
+            [post.model_dump_json() for post in self.calendar_events or []],
+        )
+
+    def mark_saved(self, fields: dict, calendar: list[str] | dict[int, str] | None = None) -> None:
+        """
+        Forget the changes a save wrote. `fields` maps each column to the value that
+        was sent and `calendar` holds the post JSON sent (the whole list or by index);
+        anything changed while the save was in flight stays dirty.
+        """
+        for name, value in fields.items():
+            if name == "image_urls":
+                object.__setattr__(self, "_image_urls_snapshot", value)
+            elif name == "step_status":
+                object.__setattr__(self, "_step_status_snapshot", value)
+            if getattr(self, name) == value:
+                self._dirty.discard(name)
+        if isinstance(calendar, list):
+            object.__setattr__(self, "_calendar_snapshot", calendar)
+            self._dirty.discard("calendar_events")
+        elif calendar:
+            for index, post_json in calendar.items():
+                self._calendar_snapshot[index] = post_json
+
+    def dirty_fields(self) -> set[str]:
+        """Scalar columns that changed (calendar_events is reported by `dirty_calendar`)."""
+        dirty = self._dirty - {"calendar_events"}
+        if list(self.image_urls or []) != self._image_urls_snapshot:
+            dirty.add("image_urls")
+        if dict(self.step_status or {}) != self._step_status_snapshot:
+            dirty.add("step_status")
+        return dirty
+
+    def dirty_calendar(self) -> list[int] | None:
+        """
+        Indexes of calendar posts that changed, or None when the whole list has to be
+        rewritten (posts added or removed).
+        """
+        posts = self.calendar_events or []
+        if len(posts) != len(self._calendar_snapshot):
+            return None
+        return [
+            index for index, post in enumerate(posts)
+            if post.model_dump_json() != self._calendar_snapshot[index]
+        ]
 
 
 class MessagePart(BaseModel):
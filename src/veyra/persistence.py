@@ -1,8 +1,14 @@
 from __future__ import annotations
+import asyncio
+import base64
+import json
 import os
+import time
 import asyncpg
-from contextlib import asynccontextmanager
-from typing import AsyncIterator
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime
+from typing import TYPE_CHECKING, AsyncIterator
+from urllib.parse import urlparse
 from pydantic import TypeAdapter
 
 
@@ -10,11 +16,39 @@ from .agents import CalendarPost
 
 from src.whatsapp.model import Message, Brand
 
+from .brand_cache import BRAND_CACHE_CHANNEL, BRAND_CACHE_NOTIFY, BrandCache
+from .metrics import gauge, histogram
 from .models import AutoMarketState, BrandInfo, WorkflowStatus
 
+if TYPE_CHECKING:
+    from .step_metrics import StepRun
+
+calendar_events_ta = TypeAdapter(list[CalendarPost])
+
 DB_URL = os.getenv("POSTGRES_URL")
 assert DB_URL, "POSTGRES_URL environment variable not set."
 
+MESSAGES_PAGE_SIZE = int(os.getenv("MESSAGES_PAGE_SIZE", "500"))
+
+WORKFLOW_COLUMNS = (
+    "thread_id",
+    "status",
+    "conversation_transcript",
+    "briefing_md",
+    "strategy_and_plan_md",
+    "image_urls",
+    "html_content",
+    "page_url",
+    "created_at",
+    "updated_at",
+    "calendar_events",
+    "step_status",
+    "image_prompt",
+    "version",
+)
+# Columns a lazy get_workflow leaves out until a step asks for them
+WORKFLOW_LAZY_COLUMNS = ("conversation_transcript", "html_content")
+
 
 class WorkflowTransitionError(Exception):
     """Raised when an invalid workflow state transition is attempted."""
@@ -22,24 +56,59 @@ class WorkflowTransitionError(Exception):
     pass
 
 
+class LockTimeoutError(Exception):
+    """Raised when an advisory lock could not be taken in time."""
+
+    pass
+
+
+class WorkflowConflictError(Exception):
+    """Raised when a workflow was saved by someone else since it was loaded."""
+
+    def __init__(self, thread_id: str, version: int):
+        super().__init__(f"Workflow {thread_id} changed since version {version}")
+        self.thread_id = thread_id
+        self.version = version
+
+
 class Storage:
     """Abstract base class for a durable storage interface."""
 
-    async def get_workflow(self, thread_id: str) -> AutoMarketState | None:
+    async def get_workflow(self, thread_id: str, lazy: bool = False) -> AutoMarketState | None:
+        raise NotImplementedError
+
+    async def ensure_loaded(self, state: AutoMarketState, *fields: str) -> AutoMarketState:
         raise NotImplementedError
 
     async def create_workflow(self, thread_id: str, transcript: str) -> AutoMarketState:
         raise NotImplementedError
 
-    async def update_workflow(self, state: AutoMarketState) -> None:
+    async def update_workflow(self, state: AutoMarketState) -> AutoMarketState:
+        raise NotImplementedError
+
+    async def update_calendar_post(self, thread_id: str, index: int, fields: dict) -> None:
         raise NotImplementedError
 
     async def get_page_content(self, thread_id: str) -> str | None:
         raise NotImplementedError
 
+    async def record_step_run(self, run: "StepRun") -> None:
+        raise NotImplementedError
+
+    async def step_run_summary(self, hours: float = 24) -> list[dict]:
+        raise NotImplementedError
+
     async def insert_message(self, message: Message):
         raise NotImplementedError
 
+    async def insert_messages(self, messages: list[Message]) -> int:
+        raise NotImplementedError
+
+    async def list_messages(
+        self, thread_id: str, cursor: str | None = None, limit: int = 100
+    ) -> tuple[list[dict], str | None]:
+        raise NotImplementedError
+
     async def get_number_by_thread_id(self, thread_id: str) -> str:
         raise NotImplementedError
 
@@ -54,60 +123,87 @@ class Storage:
 
 
 class PostgresStorage(Storage):
-    """PostgreSQL implementation of the Storage interface."""
+    """
+    PostgreSQL implementation of the Storage interface.
 
-    def __init__(self, pool: asyncpg.Pool):
+    Queries use fixed SQL text with positional parameters, so in "direct" mode
+    asyncpg's per-connection statement cache turns the hot ones (get_workflow,
+    insert_message, get_number_by_thread_id) into reused prepared plans.
+    """
+
+    def __init__(self, pool: "InstrumentedPool | asyncpg.Pool", brands: BrandCache | None = None):
         self.pool = pool
+        self.brands = brands or BrandCache()
+
+    async def _load_brand(self, phone: str) -> dict | None:
+        row = await self.pool.fetchrow(
+            "SELECT * FROM brands WHERE user_phone = $1 limit 1", phone
+        )
+        return dict(row) if row else None
 
     async def get_user_brand_by_thread_id(self, phone: str) -> BrandInfo | None:
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                "SELECT * FROM brands WHERE user_phone = $1 limit 1", phone
-            )
-            if not row:
-                return None
-            return BrandInfo(**row)
+        row = await self.brands.get(phone, self._load_brand)
+        if not row:
+            return None
+        return BrandInfo(**row)
         
     async def get_conversation(self, thread_id: str) -> str:
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch(
-                """
-                SELECT role, content
-                FROM messages
-                WHERE thread_id = $1
-                ORDER BY created_at ASC
-                """,
-                thread_id,
-            )
-            if not rows:
-                return None
-
-            # Concatenar en formato "role: content"
-            conversation = "\n".join(f"{row['role']}: {row['content']}" for row in rows)
-            return conversation
+        # Concatenar en formato "role: content"
+        lines = [f"{row['role']}: {row['content']}" async for row in self.iter_conversation(thread_id)]
+        if not lines:
+            return None
+        return "\n".join(lines)
 
     async def get_number_by_thread_id(self, thread_id: str) -> str:
         async with self.pool.acquire() as conn:
-            return await conn.fetchval(
-                "SELECT phone_number FROM messages WHERE thread_id = $1 limit 1",
-                thread_id,
+            phone = await conn.fetchval(
+                "SELECT phone_number FROM threads WHERE thread_id = $1", thread_id
             )
-
-    async def get_workflow(self, thread_id: str) -> AutoMarketState | None:
+            if phone is None:
+                # Threads created before the threads table existed
+                phone = await conn.fetchval(
+                    "SELECT phone_number FROM messages WHERE thread_id = $1 limit 1",
+                    thread_id,
+                )
+            return phone
+
+    async def get_workflow(self, thread_id: str, lazy: bool = False) -> AutoMarketState | None:
+        """
+        Load a workflow. With `lazy` the large WORKFLOW_LAZY_COLUMNS are not
+        fetched; call `ensure_loaded` before a step reads them.
+        """
+        columns = [c for c in WORKFLOW_COLUMNS if not (lazy and c in WORKFLOW_LAZY_COLUMNS)]
         async with self.pool.acquire() as conn:
             row = await conn.fetchrow(
-                "SELECT * FROM workflows WHERE thread_id = $1", thread_id
+                f"SELECT {', '.join(columns)} FROM workflows WHERE thread_id = $1", thread_id
             )
             if not row:
                 return None
 
-            # Convert row to dict and handle JSONB calendar_events
+            # Convert row to dict and parse the JSONB calendar_events (asyncpg returns text)
             row_dict = dict(row)
             if row_dict.get("calendar_events"):
-                # JSONB is already parsed by asyncpg
-                row_dict["calendar_events"] = row_dict["calendar_events"]
-
-            return AutoMarketState(**row_dict)
+                row_dict["calendar_events"] = calendar_events_ta.validate_json(
+                    row_dict["calendar_events"]
+                )
+            row_dict["step_status"] = json.loads(row_dict.get("step_status") or "{}")
+
+            skipped = [c for c in WORKFLOW_LAZY_COLUMNS if c not in row_dict]
+            state = AutoMarketState(**row_dict, **dict.fromkeys(skipped))
+            state.unloaded.update(skipped)
+            return state
+
+    async def ensure_loaded(self, state: AutoMarketState, *fields: str) -> AutoMarketState:
+        """Fetch the given lazily skipped fields (all of them if none are named)."""
+        missing = [f for f in (fields or WORKFLOW_LAZY_COLUMNS) if f in state.unloaded]
+        if missing:
+            row = await self.pool.fetchrow(
+                f"SELECT {', '.join(missing)} FROM workflows WHERE thread_id = $1",
+                state.thread_id,
+            )
+            for name in missing:
+                state.set_loaded(name, row[name] if row else None)
+        return state
 
     async def create_workflow(self, thread_id: str, transcript: str) -> AutoMarketState:
         state = AutoMarketState(
@@ -116,48 +212,136 @@ class PostgresStorage(Storage):
             conversation_transcript=transcript,
         )
         async with self.pool.acquire() as conn:
-            await conn.execute(
+            created = await conn.fetchval(
                 """
                 INSERT INTO workflows (thread_id, status, conversation_transcript)
                 VALUES ($1, $2, $3)
+                ON CONFLICT (thread_id) DO NOTHING
+                RETURNING thread_id
                 """,
                 state.thread_id,
                 state.status,
                 state.conversation_transcript,
             )
+        if created is None:
+            # Someone else created it first; continue from theirs
+            return await self.get_workflow(thread_id)
         return state
 
-    async def update_workflow(self, state: AutoMarketState) -> None:
-        events_ta = TypeAdapter(list[CalendarPost])
+    @asynccontextmanager
+    async def advisory_lock(self, key: str, timeout: float) -> AsyncIterator[None]:
+        """
+        Hold a Postgres advisory lock on `key` for the duration of the block,
+        waiting up to `timeout` seconds for it (LockTimeoutError otherwise).
+
+        The lock is transaction-scoped, so it also works behind a transaction-mode
+        pooler and is released if the connection dies; the price is one pooled
+        connection kept idle in a transaction while the block runs.
+        """
+        async with self.pool.acquire() as conn, conn.transaction():
+            if not await conn.fetchval("SELECT pg_try_advisory_xact_lock(hashtext($1))", key):
+                print(f"Waiting for lock {key}")
+                try:
+                    await conn.execute(f"SET LOCAL lock_timeout = '{int(timeout * 1000)}ms'")
+                    await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", key)
+                except asyncpg.exceptions.LockNotAvailableError as e:
+                    raise LockTimeoutError(f"Lock {key} still held after {timeout}s") from e
+            yield
+
+    async def update_workflow(self, state: AutoMarketState) -> AutoMarketState:
+        """
+        Write only the fields that changed since `state` was loaded, editing changed
+        calendar posts in place with jsonb_set. The update only applies if the row is
+        still at `state.version`; otherwise WorkflowConflictError is raised.
+
+        Returns `state` itself with the new version and updated_at, so callers can keep
+        using it without reading the row again. Only the values actually written are
+        marked clean.
+        """
         print(f"Updating workflow [{state.thread_id}] to: {state.status}")
+        async with state.lock:
+            args: list = [state.thread_id, state.version]
+            assignments = []
+
+            def param(value) -> str:
+                args.append(value)
+                return f"${len(args)}"
+
+            # What is sent is captured before the await: the other branch of the flow may
+            # change the same state meanwhile, and those changes must stay dirty.
+            sent: dict = {}
+            for name in sorted(state.dirty_fields()):
+                if name == "step_status":
+                    sent[name] = dict(state.step_status or {})
+                    assignments.append(f"step_status = {param(json.dumps(sent[name]))}::jsonb")
+                elif name == "image_urls":
+                    sent[name] = list(state.image_urls or [])
+                    assignments.append(f"image_urls = {param(sent[name])}")
+                else:
+                    sent[name] = getattr(state, name)
+                    assignments.append(f"{name} = {param(sent[name])}")
+
+            sent_calendar: list[str] | dict[int, str] | None = None
+            changed_posts = state.dirty_calendar()
+            if changed_posts is None:
+                sent_calendar = [post.model_dump_json() for post in state.calendar_events or []]
+                calendar_events_json = None
+                if state.calendar_events:
+                    calendar_events_json = calendar_events_ta.dump_json(
+                        state.calendar_events
+                    ).decode("utf-8")
+                assignments.append(f"calendar_events = {param(calendar_events_json)}::jsonb")
+            elif changed_posts:
+                sent_calendar = {}
+                expr = "calendar_events"
+                for index in changed_posts:
+                    post_json = sent_calendar[index] = state.calendar_events[index].model_dump_json()
+                    expr = f"jsonb_set({expr}, ARRAY[{param(str(index))}::text], {param(post_json)}::jsonb)"
+                assignments.append(f"calendar_events = {expr}")
+
+            if not assignments:
+                return state
+
+            async with self.pool.acquire() as conn:
+                row = await conn.fetchrow(
+                    f"""
+                    UPDATE workflows SET
+                        {", ".join(assignments)},
+                        version = version + 1,
+                        updated_at = NOW()
+                    WHERE thread_id = $1 AND version = $2
+                    RETURNING version, updated_at
+                    """,
+                    *args,
+                )
+            if row is None:
+                raise WorkflowConflictError(state.thread_id, state.version)
+            state.version = row["version"]
+            state.updated_at = row["updated_at"]
+            state.mark_saved(sent, sent_calendar)
+            return state
+
+    async def update_calendar_post(self, thread_id: str, index: int, fields: dict) -> None:
+        """
+        Merge `fields` into calendar_events[index] in place with jsonb_set,
+        without rewriting the rest of the row. This is a checkpoint: it neither checks
+        nor bumps the workflow version.
+        """
         async with self.pool.acquire() as conn:
-            calendar_events_json = None
-            if hasattr(state, "calendar_events") and state.calendar_events:
-                calendar_events_json = events_ta.dump_json(
-                    state.calendar_events
-                ).decode("utf-8")
-
             await conn.execute(
                 """
                 UPDATE workflows SET
-                    status = $2,
-                    briefing_md = $3,
-                    strategy_and_plan_md = $4,
-                    calendar_events = $5::jsonb,
-                    image_urls = $6,
-                    html_content = $7,
-                    page_url = $8,
+                    calendar_events = jsonb_set(
+                        calendar_events,
+                        ARRAY[$2::int::text],
+                        (calendar_events -> $2::int) || $3::jsonb
+                    ),
                     updated_at = NOW()
-                WHERE thread_id = $1
+                WHERE thread_id = $1 AND jsonb_array_length(calendar_events) > $2::int
                 """,
-                state.thread_id,
-                state.status,
-                state.briefing_md,
-                state.strategy_and_plan_md,
-                calendar_events_json,
-                state.image_urls,
-                state.html_content,
-                state.page_url,
+                thread_id,
+                index,
+                json.dumps(fields),
             )
 
     async def get_page_content(self, thread_id: str) -> str | None:
@@ -166,40 +350,182 @@ class PostgresStorage(Storage):
                 "SELECT html_content FROM workflows WHERE thread_id = $1", thread_id
             )
 
+    ## Step runs
+
+    async def record_step_run(self, run: "StepRun") -> None:
+        await self.pool.execute(
+            """
+            INSERT INTO workflow_step_runs (
+                thread_id, step, status, error, started_at, wall_seconds, queue_wait_seconds,
+                llm_requests, input_tokens, output_tokens,
+                images_generated, images_cached, images_fallback, render_seconds
+            )
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14)
+            """,
+            run.thread_id,
+            run.step,
+            run.status,
+            run.error,
+            run.started_at,
+            run.wall_seconds,
+            run.queue_wait_seconds,
+            run.llm_requests,
+            run.input_tokens,
+            run.output_tokens,
+            run.images_generated,
+            run.images_cached,
+            run.images_fallback,
+            run.render_seconds,
+        )
+
+    async def step_run_summary(self, hours: float = 24) -> list[dict]:
+        """p50/p95 wall time and averages per step over the last `hours`."""
+        rows = await self.pool.fetch(
+            """
+            SELECT
+                step,
+                COUNT(*) AS runs,
+                COUNT(*) FILTER (WHERE status = 'failed') AS failed,
+                percentile_cont(0.5) WITHIN GROUP (ORDER BY wall_seconds) AS p50_seconds,
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY wall_seconds) AS p95_seconds,
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY queue_wait_seconds) AS p95_queue_wait_seconds,
+                AVG(input_tokens) AS avg_input_tokens,
+                AVG(output_tokens) AS avg_output_tokens,
+                AVG(images_generated) AS avg_images_generated,
+                AVG(render_seconds) AS avg_render_seconds
+            FROM workflow_step_runs
+            WHERE started_at > NOW() - make_interval(secs => $1)
+            GROUP BY step
+            ORDER BY step
+            """,
+            hours * 3600,
+        )
+        return [dict(row) for row in rows]
+
+    ## End of Step runs
     ## Messages
 
     async def insert_message(self, message: Message):
         async with self.pool.acquire() as conn:
-            await conn.execute(
+            async with conn.transaction():
+                await conn.execute(
+                    """
+                    INSERT INTO threads (thread_id, phone_number)
+                    VALUES ($1, $2)
+                    ON CONFLICT (thread_id) DO NOTHING
+                    """,
+                    message.thread_id,
+                    message.phone_number,
+                )
+                await conn.execute(
+                    """
+                    INSERT INTO messages (phone_number, thread_id, message_id, role, content)
+                    VALUES ($1, $2, $3, $4, $5)
+                    """,
+                    message.phone_number,
+                    message.thread_id,
+                    message.message_id,
+                    message.role,
+                    message.content,
+                )
+
+    async def insert_messages(self, messages: list[Message]) -> int:
+        """
+        Bulk insert: COPY the batch into a temp table, then move it into messages
+        with ON CONFLICT DO NOTHING so re-sent message_ids are ignored.
+        Returns how many messages were new.
+        """
+        if not messages:
+            return 0
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """
+                    CREATE TEMP TABLE messages_incoming
+                        (LIKE messages INCLUDING DEFAULTS) ON COMMIT DROP
+                    """
+                )
+                await conn.copy_records_to_table(
+                    "messages_incoming",
+                    records=[
+                        (m.message_id, m.phone_number, m.created_at, m.thread_id, m.role, m.content)
+                        for m in messages
+                    ],
+                    columns=["message_id", "phone_number", "created_at", "thread_id", "role", "content"],
+                )
+                await conn.execute(
+                    """
+                    INSERT INTO threads (thread_id, phone_number)
+                    SELECT DISTINCT ON (thread_id) thread_id, phone_number
+                    FROM messages_incoming
+                    ORDER BY thread_id
+                    ON CONFLICT (thread_id) DO NOTHING
+                    """
+                )
+                result = await conn.execute(
+                    """
+                    INSERT INTO messages (message_id, phone_number, created_at, thread_id, role, content)
+                    SELECT message_id, phone_number, COALESCE(created_at, NOW()), thread_id, role, content
+                    FROM messages_incoming
+                    ON CONFLICT (message_id) DO NOTHING
+                    """
+                )
+        return int(result.rsplit(" ", 1)[-1])
+
+    async def list_messages(
+        self, thread_id: str, cursor: str | None = None, limit: int = 100
+    ) -> tuple[list[dict], str | None]:
+        """
+        One page of a thread's messages in chronological order, read through
+        idx_messages_thread_created. Returns the page and the cursor for the next
+        one (None when there are no more messages).
+        """
+        after_ts, after_id = decode_cursor(cursor) if cursor else (None, None)
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
                 """
-                INSERT INTO messages (phone_number, thread_id, message_id, role, content)
-                VALUES ($1, $2, $3, $4, $5)
+                SELECT message_id, phone_number, thread_id, role, content, created_at
+                FROM messages
+                WHERE thread_id = $1
+                  AND ($2::timestamptz IS NULL OR (created_at, message_id) > ($2::timestamptz, $3::text))
+                ORDER BY created_at, message_id
+                LIMIT $4
                 """,
-                message.phone_number,
-                message.thread_id,
-                message.message_id,
-                message.role,
-                message.content,
+                thread_id,
+                after_ts,
+                after_id,
+                limit + 1,
             )
+        messages = [dict(row) for row in rows[:limit]]
+        next_cursor = encode_cursor(messages[-1]) if len(rows) > limit else None
+        return messages, next_cursor
+
+    async def iter_conversation(
+        self, thread_id: str, page_size: int = MESSAGES_PAGE_SIZE
+    ) -> AsyncIterator[dict]:
+        """Yield a thread's messages page by page without loading the whole history."""
+        cursor = None
+        while True:
+            messages, cursor = await self.list_messages(thread_id, cursor, page_size)
+            for message in messages:
+                yield message
+            if cursor is None:
+                return
 
     ## End of Messages
     ## Brands
 
     async def get_brand_info(self, user_phone):
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                "SELECT * FROM brands WHERE user_phone = $1", user_phone
-            )
-            if not row:
-                return None
-            return dict(row)
+        row = await self.brands.get(user_phone, self._load_brand)
+        return dict(row) if row else None
 
     async def upsert_brand(self, brand: Brand) -> int:
         """
         Inserta o actualiza un registro en la tabla 'brands' basado en user_phone.
-        Devuelve el brand_id final.
+        Devuelve el brand_id final e invalida la marca en la caché (y en las
+        demás réplicas si BRAND_CACHE_NOTIFY está activo).
         """
-        async with self.pool.acquire() as conn:
+        async with self.pool.acquire() as conn, conn.transaction():
             row = await conn.fetchrow(
                 """
                 INSERT INTO brands (brand_name, user_phone, brand_logo, main_color, user_name)
@@ -218,20 +544,178 @@ class PostgresStorage(Storage):
                 brand.main_color,
                 brand.user_name,
             )
-            return row["brand_id"]
+            if BRAND_CACHE_NOTIFY:
+                # Delivered on commit
+                await conn.execute("SELECT pg_notify($1, $2)", BRAND_CACHE_CHANNEL, brand.user_phone)
+        self.brands.invalidate(brand.user_phone)
+        return row["brand_id"]
 
     ## End of Brands
 
 
+def encode_cursor(message: dict) -> str:
+    raw = f"{message['created_at'].isoformat()}|{message['message_id']}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, str]:
+    created_at, message_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|", 1)
+    return datetime.fromisoformat(created_at), message_id
+
+
+# "direct": talking to Postgres itself, named prepared statements are cached and
+#           reused per connection (hot queries run as prepared plans).
+# "pgbouncer": a transaction-mode pooler sits in front; only unnamed statements.
+# "auto": decide at startup with `detect_connection_mode`.
+POSTGRES_CONNECTION_MODE = os.getenv("POSTGRES_CONNECTION_MODE", "auto")
+POSTGRES_STATEMENT_CACHE_SIZE = int(os.getenv("POSTGRES_STATEMENT_CACHE_SIZE", "256"))
+POOLER_PORTS = {6432, 6543}
+
+POSTGRES_POOL_MIN_SIZE = int(os.getenv("POSTGRES_POOL_MIN_SIZE", "1"))
+POSTGRES_POOL_MAX_SIZE = int(os.getenv("POSTGRES_POOL_MAX_SIZE", "8"))
+POSTGRES_POOL_IDLE_TIMEOUT = float(os.getenv("POSTGRES_POOL_IDLE_TIMEOUT", "60"))
+
+pool_acquire_seconds = histogram(
+    "db_pool_acquire_seconds", "Time spent waiting for a pooled Postgres connection",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+pool_size = gauge("db_pool_connections", "Open connections in the Postgres pool")
+pool_in_use = gauge("db_pool_connections_in_use", "Postgres pool connections currently checked out")
+pool_utilization = gauge("db_pool_utilization", "Checked-out connections / pool max size")
+
+_connection_mode: str | None = None
+
+
+def pool_options(mode: str) -> dict:
+    if mode == "pgbouncer":
+        return dict(
+            statement_cache_size=0,  # <- clave
+            max_cached_statement_lifetime=0,
+            max_cacheable_statement_size=0,
+        )
+    return dict(statement_cache_size=POSTGRES_STATEMENT_CACHE_SIZE)
+
+
+async def detect_connection_mode(dsn: str, probes: int = 6, timeout: float = 5.0) -> str:
+    """
+    Guess whether a transaction-mode pooler is in front of Postgres; anything
+    not proven direct is treated as "pgbouncer".
+    Checks DSN hints first (pgbouncer=true, the usual pooler ports). Then two
+    client connections hold a transaction open at the same time, in alternating
+    order: a direct connection keeps its own backend pid in every probe and never
+    shares it with the other. A pooler shows up as a pid that moves, a pid seen by
+    both connections, or a second transaction that cannot get a server in time.
+    """
+    parsed = urlparse(dsn)
+    if "pgbouncer=true" in (parsed.query or "") or parsed.port in POOLER_PORTS:
+        return "pgbouncer"
+
+    conns = [await asyncpg.connect(dsn, **pool_options("pgbouncer")) for _ in range(2)]
+    try:
+        backends: list[set[int]] = [set(), set()]
+        for probe in range(probes):
+            order = list(range(2)) if probe % 2 == 0 else [1, 0]
+            transactions = {i: conns[i].transaction() for i in order}
+            try:
+                for i in order:
+                    await asyncio.wait_for(transactions[i].start(), timeout=timeout)
+                    pid = await asyncio.wait_for(conns[i].fetchval("SELECT pg_backend_pid()"), timeout=timeout)
+                    backends[i].add(pid)
+            except asyncio.TimeoutError:
+                return "pgbouncer"
+            finally:
+                for i in order:
+                    with suppress(Exception):
+                        await transactions[i].rollback()
+        direct = all(len(pids) == 1 for pids in backends) and not backends[0] & backends[1]
+        return "direct" if direct else "pgbouncer"
+    finally:
+        for conn in conns:
+            await conn.close()
+
+
+async def resolve_connection_mode() -> str:
+    global _connection_mode
+    if _connection_mode is None:
+        mode = POSTGRES_CONNECTION_MODE
+        if mode == "auto":
+            try:
+                mode = await detect_connection_mode(DB_URL)
+            except Exception as e:
+                print(f"Connection mode probe failed ({e}), assuming pgbouncer")
+                mode = "pgbouncer"
+        _connection_mode = mode
+        print(f"Postgres connection mode: {mode}")
+    return _connection_mode
+
+
+class InstrumentedPool:
+    """
+    asyncpg.Pool proxy that records how long callers wait for a connection and
+    how many connections are in use. Everything else is delegated to the pool.
+    """
+
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    @asynccontextmanager
+    async def acquire(self, *, timeout: float | None = None) -> AsyncIterator[asyncpg.Connection]:
+        start = time.perf_counter()
+        conn = await self._pool.acquire(timeout=timeout)
+        pool_acquire_seconds.observe(time.perf_counter() - start)
+        self._report()
+        try:
+            yield conn
+        finally:
+            await self._pool.release(conn)
+            self._report()
+
+    async def execute(self, query: str, *args, timeout: float | None = None) -> str:
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args, timeout=timeout)
+
+    async def fetch(self, query: str, *args, timeout: float | None = None) -> list:
+        async with self.acquire() as conn:
+            return await conn.fetch(query, *args, timeout=timeout)
+
+    async def fetchrow(self, query: str, *args, timeout: float | None = None):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(query, *args, timeout=timeout)
+
+    async def fetchval(self, query: str, *args, column: int = 0, timeout: float | None = None):
+        async with self.acquire() as conn:
+            return await conn.fetchval(query, *args, column=column, timeout=timeout)
+
+    def _report(self) -> None:
+        size = self._pool.get_size()
+        pool_size.set(size)
+        pool_in_use.set(size - self._pool.get_idle_size())
+        pool_utilization.set((size - self._pool.get_idle_size()) / self._pool.get_max_size())
+
+
+async def create_pool(**kwargs) -> InstrumentedPool:
+    """
+    The app's single asyncpg pool, configured for the detected (or configured)
+    connection mode and sized by POSTGRES_POOL_MIN_SIZE / POSTGRES_POOL_MAX_SIZE.
+    """
+    mode = await resolve_connection_mode()
+    options = dict(
+        min_size=POSTGRES_POOL_MIN_SIZE,
+        max_size=POSTGRES_POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=POSTGRES_POOL_IDLE_TIMEOUT,
+    )
+    options.update(kwargs)
+    pool = await asyncpg.create_pool(dsn=DB_URL, **pool_options(mode), **options)
+    return InstrumentedPool(pool)
+
+
 @asynccontextmanager
-async def db_pool() -> AsyncIterator[asyncpg.Pool]:
+async def db_pool() -> AsyncIterator[InstrumentedPool]:
     """Provides a connection pool to the PostgreSQL database."""
-    pool = await asyncpg.create_pool(
-        dsn=DB_URL,
-        statement_cache_size=0,  # <- clave
-        max_cached_statement_lifetime=0,  # opcional, aún más seguro
-        max_cacheable_statement_size=0,
-    )
+    pool = await create_pool()
     try:
         async with pool.acquire() as conn:
             await conn.execute(
@@ -249,6 +733,9 @@ async def db_pool() -> AsyncIterator[asyncpg.Pool]:
                     updated_at TIMESTAMPTZ DEFAULT NOW()
                 );
                 ALTER TABLE workflows ADD COLUMN IF NOT EXISTS calendar_events JSONB;
+                ALTER TABLE workflows ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0;
+                ALTER TABLE workflows ADD COLUMN IF NOT EXISTS step_status JSONB NOT NULL DEFAULT '{}'::jsonb;
+                ALTER TABLE workflows ADD COLUMN IF NOT EXISTS image_prompt TEXT;
             """
             )
 
@@ -268,8 +755,23 @@ async def db_pool() -> AsyncIterator[asyncpg.Pool]:
                     role VARCHAR(12) NOT NULL,
                     content TEXT
                 );
+                CREATE INDEX IF NOT EXISTS idx_messages_thread_created
+                    ON messages (thread_id, created_at, message_id);
+
+                CREATE TABLE IF NOT EXISTS threads (
+                    thread_id VARCHAR(48) PRIMARY KEY,
+                    phone_number VARCHAR(16) NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+                -- One-time backfill from existing messages
+                INSERT INTO threads (thread_id, phone_number, created_at)
+                SELECT DISTINCT ON (thread_id) thread_id, phone_number, created_at
+                FROM messages
+                WHERE NOT EXISTS (SELECT 1 FROM threads)
+                ORDER BY thread_id, created_at
+                ON CONFLICT (thread_id) DO NOTHING;
             """
-            )  # TODO: Create index by thread id over messages tabl
+            )
 
             await conn.execute(
                 """
@@ -285,6 +787,84 @@ async def db_pool() -> AsyncIterator[asyncpg.Pool]:
                 """
             )
 
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS image_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    engine TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    prompt TEXT NOT NULL,
+                    resolution TEXT NOT NULL,
+                    image_url TEXT NOT NULL,
+                    object_key TEXT NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    last_hit_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+                CREATE INDEX IF NOT EXISTS idx_image_cache_last_hit ON image_cache(last_hit_at);
+                """
+            )
+
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id BIGSERIAL PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL DEFAULT 5,
+                    run_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    locked_by TEXT,
+                    locked_until TIMESTAMPTZ,
+                    last_error TEXT,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+                CREATE INDEX IF NOT EXISTS idx_jobs_runnable ON jobs (run_at)
+                    WHERE status IN ('queued', 'running');
+                ALTER TABLE jobs ADD COLUMN IF NOT EXISTS dedup_key TEXT;
+                -- At most one active job per (kind, dedup_key)
+                CREATE UNIQUE INDEX IF NOT EXISTS uq_jobs_active_dedup ON jobs (kind, dedup_key)
+                    WHERE status IN ('queued', 'running');
+                """
+            )
+
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS workflow_step_runs (
+                    run_id BIGSERIAL PRIMARY KEY,
+                    thread_id TEXT NOT NULL,
+                    step TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    started_at TIMESTAMPTZ NOT NULL,
+                    wall_seconds DOUBLE PRECISION NOT NULL,
+                    queue_wait_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    llm_requests INTEGER NOT NULL DEFAULT 0,
+                    input_tokens INTEGER NOT NULL DEFAULT 0,
+                    output_tokens INTEGER NOT NULL DEFAULT 0,
+                    images_generated INTEGER NOT NULL DEFAULT 0,
+                    images_cached INTEGER NOT NULL DEFAULT 0,
+                    images_fallback INTEGER NOT NULL DEFAULT 0,
+                    render_seconds DOUBLE PRECISION NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS idx_step_runs_started ON workflow_step_runs (started_at);
+                CREATE INDEX IF NOT EXISTS idx_step_runs_thread ON workflow_step_runs (thread_id);
+                """
+            )
+
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS processed_webhook_messages (
+                    message_id TEXT PRIMARY KEY,
+                    received_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+                CREATE INDEX IF NOT EXISTS idx_processed_webhook_received
+                    ON processed_webhook_messages (received_at);
+                """
+            )
+
         yield pool
     finally:
         await pool.close()
@@ -0,0 +1,120 @@
+"""
+Small staged pipeline: items flow through a list of async stages connected by
+bounded queues, each stage with its own worker count. Memory stays flat because
+a stage can only run ahead of the next one by its queue size.
+"""
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Iterable
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable[[Any], Awaitable[Any]]
+    concurrency: int = 1
+
+
+class StageError(Exception):
+    """An item failed in `stage`; later stages skip it."""
+
+    def __init__(self, stage: str, error: BaseException):
+        super().__init__(f"{stage}: {error}")
+        self.stage = stage
+        self.error = error
+
+
+_STOP = object()
+
+
+async def run_pipeline(
+    items: Iterable[Any],
+    stages: list[Stage],
+    *,
+    ordered: bool = False,
+    queue_size: int | None = None,
+) -> list[Any]:
+    """
+    Run every item through `stages` and return the final values in input order
+    (a `StageError` in place of items that failed).
+
+    With `ordered=False` the last stage sees items as soon as they are ready
+    (as-completed delivery). With `ordered=True` the last stage runs with a single
+    worker and receives items strictly in input order; items are only admitted
+    while fewer than `queue_size` (default: the total worker count) are waiting
+    for their turn, so a slow head item cannot make the others pile up.
+    """
+    items = list(items)
+    if not stages:
+        return items
+    if ordered:
+        stages = stages[:-1] + [Stage(stages[-1].name, stages[-1].fn, concurrency=1)]
+
+    queues = [asyncio.Queue(maxsize=queue_size or max(1, stage.concurrency)) for stage in stages]
+    results: list[Any] = [None] * len(items)
+    sequenced = ordered and len(stages) > 1
+    # Items admitted but not yet handed to the last stage (only limited when ordered)
+    window = asyncio.Semaphore(queue_size or sum(stage.concurrency for stage in stages)) if sequenced else None
+
+    async def feed():
+        for idx, item in enumerate(items):
+            if window is not None:
+                await window.acquire()
+            await queues[0].put((idx, item))
+
+    async def work(stage: Stage, inbox: asyncio.Queue, outbox: asyncio.Queue | None):
+        while True:
+            msg = await inbox.get()
+            if msg is _STOP:
+                return
+            idx, value = msg
+            if not isinstance(value, StageError):
+                try:
+                    value = await stage.fn(value)
+                except Exception as e:
+                    value = StageError(stage.name, e)
+            if outbox is None:
+                results[idx] = value
+            else:
+                await outbox.put((idx, value))
+
+    async def sequence(inbox: asyncio.Queue, outbox: asyncio.Queue):
+        """Re-emit (idx, value) pairs in index order."""
+        pending: dict[int, Any] = {}
+        next_idx = 0
+        while next_idx < len(items):
+            msg = await inbox.get()
+            if msg is _STOP:
+                break
+            idx, value = msg
+            pending[idx] = value
+            while next_idx in pending:
+                await outbox.put((next_idx, pending.pop(next_idx)))
+                window.release()
+                next_idx += 1
+
+    async def run_stage(i: int, inbox: asyncio.Queue):
+        stage = stages[i]
+        outbox = queues[i + 1] if i + 1 < len(stages) else None
+        if ordered and i + 2 == len(stages):
+            # Feed the last stage through a sequencer instead of directly.
+            reorder: asyncio.Queue = asyncio.Queue()
+            sequencer = asyncio.create_task(sequence(reorder, outbox))
+            await asyncio.gather(*[work(stage, inbox, reorder) for _ in range(stage.concurrency)])
+            await reorder.put(_STOP)
+            await sequencer
+        else:
+            await asyncio.gather(*[work(stage, inbox, outbox) for _ in range(stage.concurrency)])
+        if outbox is not None:
+            for _ in range(stages[i + 1].concurrency):
+                await outbox.put(_STOP)
+
+    async def run_feed():
+        await feed()
+        for _ in range(stages[0].concurrency):
+            await queues[0].put(_STOP)
+
+    await asyncio.gather(run_feed(), *[run_stage(i, queues[i]) for i in range(len(stages))])
+    return results
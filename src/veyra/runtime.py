@@ -0,0 +1,43 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from typing import AsyncIterator
+
+from src.whatsapp.client import whatsapp_client
+from src.whatsapp.dedup import message_dedup
+
+from .brand_cache import BRAND_CACHE_NOTIFY
+from .image_cache import image_cache
+from .metrics import monitor_event_loop_lag
+from .persistence import DB_URL, PostgresStorage, db_pool, resolve_connection_mode
+from .s3 import s3_client
+from .workflow import renderer
+
+
+@asynccontextmanager
+async def app_runtime() -> AsyncIterator[PostgresStorage]:
+    """
+    Shared process resources for the web app and the worker: the Postgres pool,
+    the S3 client, the WhatsApp API client, the image and brand caches, the webhook dedup store, the renderer
+    and the event-loop lag probe.
+    """
+    loop_monitor = asyncio.create_task(monitor_event_loop_lag())
+    try:
+        async with db_pool() as pool, s3_client():
+            storage = PostgresStorage(pool)
+            image_cache.attach(pool)
+            message_dedup.attach(pool)
+            whatsapp_client.open()
+            if BRAND_CACHE_NOTIFY:
+                await storage.brands.listen(DB_URL, pooled=await resolve_connection_mode() == "pgbouncer")
+            try:
+                yield storage
+            finally:
+                await storage.brands.close()
+                await whatsapp_client.close()
+                message_dedup.attach(None)
+                image_cache.attach(None)
+                await renderer.stop()
+    finally:
+        loop_monitor.cancel()
+        with suppress(asyncio.CancelledError):
+            await loop_monitor
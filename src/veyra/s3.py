@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
+from io import BytesIO
+from typing import AsyncIterator, Iterable
+
+import aioboto3
+from aiobotocore.config import AioConfig
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from .metrics import counter
+
+
+BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
+ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+REGION_NAME = os.getenv("REGION_NAME") or "us-east-1"
+ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
+SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+print(
+    "S3_BUCKET_NAME", BUCKET_NAME,
+    "S3_ENDPOINT_URL", ENDPOINT_URL,
+    "REGION_NAME", REGION_NAME,
+    "AWS_ACCESS_KEY", ACCESS_KEY,
+)
+
+MB = 1024 * 1024
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "20"))
+S3_UPLOAD_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", "8"))
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.getenv("S3_MULTIPART_THRESHOLD_MB", "8")) * MB,
+    multipart_chunksize=int(os.getenv("S3_MULTIPART_CHUNKSIZE_MB", "8")) * MB,
+    max_concurrency=int(os.getenv("S3_MULTIPART_CONCURRENCY", "4")),
+)
+
+S3_DEDUP_INDEX_SIZE = int(os.getenv("S3_DEDUP_INDEX_SIZE", "4096"))
+
+uploads_total = counter("s3_uploads_total", "Objects actually written to the bucket")
+dedup_hits = counter("s3_dedup_hits_total", "Uploads skipped because the content already exists")
+
+_client = None
+_stack: AsyncExitStack | None = None
+_client_lock = asyncio.Lock()
+
+
+async def get_s3_client():
+    """Return the process-wide S3 client, opening it (and its connection pool) on first use."""
+    global _client, _stack
+    if _client is None:
+        async with _client_lock:
+            if _client is None:
+                stack = AsyncExitStack()
+                _client = await stack.enter_async_context(
+                    aioboto3.Session().client(
+                        "s3",
+                        region_name=REGION_NAME,
+                        endpoint_url=f"{ENDPOINT_URL}/s3",
+                        aws_access_key_id=ACCESS_KEY,
+                        aws_secret_access_key=SECRET_KEY,
+                        config=AioConfig(
+                            max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                            tcp_keepalive=True,
+                        ),
+                    )
+                )
+                _stack = stack
+    return _client
+
+
+async def close_s3_client() -> None:
+    global _client, _stack
+    if _stack is not None:
+        await _stack.aclose()
+    _client = None
+    _stack = None
+
+
+@asynccontextmanager
+async def s3_client() -> AsyncIterator:
+    """Keeps one S3 client open for the app's lifetime (use from the FastAPI lifespan)."""
+    client = await get_s3_client()
+    try:
+        yield client
+    finally:
+        await close_s3_client()
+
+
+def public_url(key: str) -> str:
+    return f"{ENDPOINT_URL}/object/public/{BUCKET_NAME}/{key}"
+
+
+def content_key(data: bytes, ext: str) -> str:
+    return f"{hashlib.sha256(data).hexdigest()}.{ext}"
+
+
+# key -> public URL of objects known to exist in the bucket (LRU)
+_known_keys: OrderedDict[str, str] = OrderedDict()
+# key -> upload in progress, so concurrent uploads of the same bytes share one request
+_inflight: dict[str, asyncio.Task] = {}
+
+
+def _remember(key: str) -> str:
+    url = _known_keys.get(key) or public_url(key)
+    _known_keys[key] = url
+    _known_keys.move_to_end(key)
+    while len(_known_keys) > S3_DEDUP_INDEX_SIZE:
+        _known_keys.popitem(last=False)
+    return url
+
+
+async def _exists(key: str) -> bool:
+    client = await get_s3_client()
+    try:
+        await client.head_object(Bucket=BUCKET_NAME, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+async def _put(data: bytes, key: str, content_type: str) -> None:
+    client = await get_s3_client()
+    await client.upload_fileobj(
+        BytesIO(data),
+        BUCKET_NAME,
+        key,
+        ExtraArgs={"ContentType": content_type},
+        Config=TRANSFER_CONFIG,
+    )
+    uploads_total.inc()
+
+
+async def _upload_if_missing(data: bytes, key: str, content_type: str) -> str:
+    if await _exists(key):
+        dedup_hits.inc(source="bucket")
+    else:
+        await _put(data, key, content_type)
+    return _remember(key)
+
+
+async def upload_to_s3(
+    image_bytes: bytes,
+    ext: str = "png",
+    content_type: str | None = None,
+    dedup: bool = True,
+) -> str:
+    """
+    Upload bytes and return their public URL.
+    With `dedup` the key is the SHA-256 of the content: if the object is already in
+    the local index or in the bucket, its existing URL is returned without uploading.
+    Objects above the multipart threshold are sent in parallel parts.
+    """
+    content_type = content_type or f"image/{ext}"
+    if not dedup:
+        filename = f"{uuid.uuid4()}.{ext}"
+        await _put(image_bytes, filename, content_type)
+        return public_url(filename)
+
+    key = content_key(image_bytes, ext)
+    if key in _known_keys:
+        dedup_hits.inc(source="index")
+        return _remember(key)
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_upload_if_missing(image_bytes, key, content_type))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        dedup_hits.inc(source="inflight")
+    return await asyncio.shield(task)
+
+
+async def download_from_s3(key: str) -> bytes:
+    client = await get_s3_client()
+    response = await client.get_object(Bucket=BUCKET_NAME, Key=key)
+    async with response["Body"] as body:
+        return await body.read()
+
+
+async def upload_many(
+    items: Iterable[tuple[bytes, str]],
+    concurrency: int = S3_UPLOAD_CONCURRENCY,
+) -> list[str]:
+    """Upload `(bytes, ext)` pairs concurrently over the shared client; URLs come back in input order."""
+    slots = asyncio.Semaphore(concurrency)
+
+    async def _upload(data: bytes, ext: str) -> str:
+        async with slots:
+            return await upload_to_s3(data, ext)
+
+    return list(await asyncio.gather(*[_upload(data, ext) for data, ext in items]))
@@ -0,0 +1,32 @@
+"""
+In-process single-flight: concurrent calls for the same key share one execution
+and all get its result (or exception).
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable
+
+from .metrics import counter
+
+coalesced_total = counter("singleflight_coalesced_total", "Calls that attached to an execution already running")
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    def running(self, key: str) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            coalesced_total.inc(flight=self.name)
+        # A caller going away (e.g. its job lost the lease) must not cancel the shared run
+        return await asyncio.shield(task)
@@ -0,0 +1,143 @@
+"""
+Per-step instrumentation of the generation flow.
+
+`step_run()` opens a StepRun for the current step in a context variable; code
+running inside the step (including tasks it spawns) adds LLM usage, image and
+render figures to it with the `record_*` helpers, which are no-ops outside a
+step. When the step ends the run is exported to the histograms below and
+persisted to `workflow_step_runs`.
+"""
+from __future__ import annotations
+
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, AsyncIterator
+
+from .metrics import counter, histogram
+
+if TYPE_CHECKING:
+    from .persistence import Storage
+
+step_seconds = histogram("pipeline_step_seconds", "Wall time of each generation step")
+step_queue_wait = histogram(
+    "pipeline_step_queue_wait_seconds", "Time a generation step waited between becoming ready and starting"
+)
+step_render_seconds = histogram("pipeline_step_render_seconds", "Time spent rendering posts, per step")
+llm_tokens = counter("pipeline_llm_tokens_total", "LLM tokens used by generation steps, by direction")
+images_total = counter("pipeline_images_total", "Images produced by generation steps, by source")
+step_runs_total = counter("pipeline_step_runs_total", "Generation step runs, by outcome")
+
+
+@dataclass
+class StepRun:
+    thread_id: str
+    step: str
+    queue_wait_seconds: float = 0.0
+    started_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    wall_seconds: float = 0.0
+    status: str = "running"
+    error: str | None = None
+    llm_requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    images_generated: int = 0
+    images_cached: int = 0
+    images_fallback: int = 0
+    render_seconds: float = 0.0
+
+
+_current: ContextVar[StepRun | None] = ContextVar("current_step_run", default=None)
+
+
+def current_step() -> StepRun | None:
+    return _current.get()
+
+
+def record_usage(result) -> None:
+    """Add the token usage of a pydantic-ai run result to the current step."""
+    run = _current.get()
+    if run is None:
+        return
+    usage = result.usage()
+    input_tokens = getattr(usage, "input_tokens", None) or getattr(usage, "request_tokens", None) or 0
+    output_tokens = getattr(usage, "output_tokens", None) or getattr(usage, "response_tokens", None) or 0
+    run.llm_requests += getattr(usage, "requests", 0) or 0
+    run.input_tokens += input_tokens
+    run.output_tokens += output_tokens
+
+
+def record_image(source: str) -> None:
+    """Count an image of the current step: "generated", "cached" or "fallback"."""
+    run = _current.get()
+    if run is None:
+        return
+    attr = f"images_{source}"
+    setattr(run, attr, getattr(run, attr) + 1)
+
+
+def record_render(seconds: float) -> None:
+    run = _current.get()
+    if run is not None:
+        run.render_seconds += seconds
+
+
+@asynccontextmanager
+async def step_run(
+    storage: "Storage | None", thread_id: str, step: str, queue_wait: float = 0.0
+) -> AsyncIterator[StepRun]:
+    run = StepRun(thread_id=thread_id, step=step, queue_wait_seconds=queue_wait)
+    token = _current.set(run)
+    start = time.perf_counter()
+    try:
+        yield run
+        run.status = "done"
+    except BaseException as e:
+        run.status = "failed"
+        run.error = repr(e)[:2000]
+        raise
+    finally:
+        run.wall_seconds = time.perf_counter() - start
+        _current.reset(token)
+        _export(run)
+        if storage is not None:
+            try:
+                await storage.record_step_run(run)
+            except Exception as e:
+                print(f"Could not persist step run {step} for {thread_id}: {e}")
+
+
+def _export(run: StepRun) -> None:
+    step_seconds.observe(run.wall_seconds, step=run.step)
+    step_queue_wait.observe(run.queue_wait_seconds, step=run.step)
+    if run.render_seconds:
+        step_render_seconds.observe(run.render_seconds, step=run.step)
+    if run.input_tokens:
+        llm_tokens.inc(run.input_tokens, step=run.step, direction="input")
+    if run.output_tokens:
+        llm_tokens.inc(run.output_tokens, step=run.step, direction="output")
+    for source in ("generated", "cached", "fallback"):
+        count = getattr(run, f"images_{source}")
+        if count:
+            images_total.inc(count, step=run.step, source=source)
+    step_runs_total.inc(step=run.step, outcome=run.status)
+    print(
+        f"[{run.thread_id}] step {run.step} {run.status} in {run.wall_seconds:.1f}s "
+        f"(tokens in/out {run.input_tokens}/{run.output_tokens}, "
+        f"images {run.images_generated}+{run.images_cached} cached, render {run.render_seconds:.1f}s)"
+    )
+
+
+def live_percentiles() -> dict[str, dict]:
+    """p50/p95 of recent step wall times kept in this process."""
+    summary = {}
+    for labels in step_seconds.label_sets():
+        step = labels["step"]
+        summary[step] = {
+            "p50": step_seconds.quantile(0.5, step=step),
+            "p95": step_seconds.quantile(0.95, step=step),
+            "queue_wait_p95": step_queue_wait.quantile(0.95, step=step),
+        }
+    return summary
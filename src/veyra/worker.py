@@ -0,0 +1,43 @@
+"""
+Standalone job worker: `python -m src.veyra.worker`.
+
+Runs queued generation flows outside the web process, so throughput scales with
+the number of worker machines and a web deploy/auto-stop no longer kills them.
+"""
+import asyncio
+import signal
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from .jobs import GENERATION_JOB, JobQueue, Worker
+from .persistence import PostgresStorage
+from .runtime import app_runtime
+from .workflow import run_generation_once
+
+def build_worker(storage: PostgresStorage) -> Worker:
+    async def run_generation(payload: dict) -> None:
+        await run_generation_once(thread_id=payload["thread_id"], storage=storage)
+
+    return Worker(JobQueue(storage.pool), {GENERATION_JOB: run_generation})
+
+
+async def main() -> None:
+    async with app_runtime() as storage:
+        worker = build_worker(storage)
+        run = asyncio.create_task(worker.run())
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+
+        print("Worker stopping, waiting for running jobs...")
+        await worker.stop()
+        run.cancel()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,18 +1,18 @@
 import asyncio
+import time
 from typing import Any, Awaitable, Callable
 
-from agno.tools.whatsapp import WhatsAppTools
-from agno.utils.whatsapp import (
-    send_image_message_async,
-    upload_media_async,
-)
 import logfire
 from fastapi import HTTPException
-from pydantic import TypeAdapter
 
 from src.marketing.template_renderer import RenderService
+from src.whatsapp.client import whatsapp_client
 
+from .dag import DONE, FAILED, Node, run_dag
 from .img_gen import generate_image
+from .pipeline import Stage, StageError, run_pipeline
+from .singleflight import SingleFlight
+from .step_metrics import record_render, record_usage, step_run
 
 from .v0_client import (
     Attachment,
@@ -32,16 +32,25 @@ from .agents import (
 )
 from .persistence import PostgresStorage
 
-from typing import List, Tuple
 import os
 
 # Type alias for step handlers
 StepHandler = Callable[[str, Any, PostgresStorage], Awaitable[None]]
 client = V0ApiClient(api_key=os.getenv("V0_API_KEY") or "")
 
-wpp = WhatsAppTools()
 renderer = RenderService("templates")
 
+# How long a duplicate trigger waits for another process's run of the same thread.
+GENERATION_LOCK_TIMEOUT = float(os.getenv("GENERATION_LOCK_TIMEOUT", "900"))
+
+generation_flights = SingleFlight("generation")
+
+# Images step: workers per stage and delivery order ("as_completed" | "ordered").
+IMAGES_GENERATE_CONCURRENCY = int(os.getenv("IMAGES_GENERATE_CONCURRENCY", "4"))
+IMAGES_RENDER_CONCURRENCY = int(os.getenv("IMAGES_RENDER_CONCURRENCY", str(renderer.pool_size)))
+IMAGES_DELIVER_CONCURRENCY = int(os.getenv("IMAGES_DELIVER_CONCURRENCY", "2"))
+IMAGES_DELIVERY_MODE = os.getenv("IMAGES_DELIVERY_MODE", "as_completed")
+
 async def _run_v0_page_step(
     thread_id: str, workflow: AutoMarketState, storage: PostgresStorage
 ) -> None:
@@ -86,18 +95,71 @@ async def _run_v0_page_step(
         )
 
         workflow.page_url = chat.demo
-
-        workflow.status = WorkflowStatus.HTML_COMPLETE
+        # Saved before telling the user, so a retry does not create a second page
         await storage.update_workflow(workflow)
-        await wpp.send_text_message_async(
-            recipient=user_number,
-            text="¡Listo! Tu landing page está lista. Puedes verla en el siguiente enlace: "
+        await whatsapp_client.send_text(
+            user_number,
+            "¡Listo! Tu landing page está lista. Puedes verla en el siguiente enlace: "
             + chat.demo,
         )
 
 
+# Generation flow as a dependency graph: the landing page only needs the briefing
+# and the strategy, so it runs alongside calendar -> images.
+FLOW = [
+    Node("briefing"),
+    Node("strategy", ["briefing"]),
+    Node("calendar", ["strategy"]),
+    Node("images", ["calendar"]),
+    Node("v0_page", ["strategy"]),
+]
+
+# Legacy linear status reached once every step up to that point is done.
+LEGACY_STATUS = [
+    ("briefing", WorkflowStatus.BRIEFING_COMPLETE),
+    ("strategy", WorkflowStatus.STRATEGY_COMPLETE),
+    ("calendar", WorkflowStatus.CALENDAR_COMPLETE),
+    ("images", WorkflowStatus.IMAGES_COMPLETE),
+    ("v0_page", WorkflowStatus.HTML_COMPLETE),
+]
+
+
+def derive_status(step_status: dict[str, str]) -> WorkflowStatus:
+    status = WorkflowStatus.STARTED
+    for step, reached in LEGACY_STATUS:
+        if step_status.get(step) != DONE:
+            break
+        status = reached
+    return status
+
+
+def step_status_from_legacy(status: WorkflowStatus) -> dict[str, str]:
+    """Per-step status for workflows saved before step_status existed."""
+    if status == WorkflowStatus.PUBLISHED:
+        return {step: DONE for step, _ in LEGACY_STATUS}
+    reached = [value for _, value in LEGACY_STATUS]
+    if status not in reached:
+        return {}
+    return {step: DONE for step, _ in LEGACY_STATUS[: reached.index(status) + 1]}
+
+
+async def run_generation_once(thread_id: str, storage: PostgresStorage) -> None:
+    """
+    Single-flight entry point for the generation flow. Duplicate triggers in this
+    process attach to the run in progress. Across processes, a per-thread advisory
+    lock makes a duplicate wait for the other run; once it finishes, every step is
+    done and the duplicate's run returns right away.
+    """
+    async def run_locked() -> None:
+        async with storage.advisory_lock(f"generation:{thread_id}", GENERATION_LOCK_TIMEOUT):
+            await run_generation_flow(thread_id, storage)
+
+    await generation_flights.do(thread_id, run_locked)
+
+
 async def run_generation_flow(thread_id: str, storage: PostgresStorage) -> None:
-    workflow = await storage.get_workflow(thread_id)
+    # Large columns (transcript, html) are only fetched by the steps that read them
+    workflow = await storage.get_workflow(thread_id, lazy=True)
     if not workflow:
         logfire.error(
             "Workflow not found for thread {thread_id}, creating workflow",
@@ -113,84 +175,88 @@ async def run_generation_flow(thread_id: str, storage: PostgresStorage) -> None:
     print(f"Running generation flow for thread {thread_id}")
     user_number = await storage.get_number_by_thread_id(thread_id)
 
-    # Define ordered flow steps as tuples (from_status, to_status, handler)
-    flow_steps: List[Tuple[WorkflowStatus, WorkflowStatus, StepHandler]] = [
-        (WorkflowStatus.STARTED, WorkflowStatus.BRIEFING_COMPLETE, _run_briefing_step),
-        (
-            WorkflowStatus.BRIEFING_COMPLETE,
-            WorkflowStatus.STRATEGY_COMPLETE,
-            _run_strategy_step,
-        ),
-        (
-            WorkflowStatus.STRATEGY_COMPLETE,
-            WorkflowStatus.CALENDAR_COMPLETE,
-            _run_calendar_step,
-        ),
-        (
-            WorkflowStatus.CALENDAR_COMPLETE,
-            WorkflowStatus.IMAGES_COMPLETE,
-            _make_run_images_step(number=user_number),
-        ),
-        (
-            WorkflowStatus.IMAGES_COMPLETE,
-            WorkflowStatus.HTML_COMPLETE,
-            _run_v0_page_step,
-        ),
-    ]
-
-    # Execute steps starting from current status
-    for from_status, to_status, handler in flow_steps:
-        if not workflow:
-            raise HTTPException(status_code=404, detail="Workflow not found")
-        if workflow.status == from_status:
-            await handler(thread_id, workflow, storage)
-            workflow = await storage.get_workflow(thread_id)  # Refresh workflow state
+    handlers: dict[str, StepHandler] = {
+        "briefing": _run_briefing_step,
+        "strategy": _run_strategy_step,
+        "calendar": _run_calendar_step,
+        "images": _make_run_images_step(number=user_number),
+        "v0_page": _run_v0_page_step,
+    }
+    if not workflow.step_status:
+        workflow.step_status = step_status_from_legacy(workflow.status)
+
+    flow_started = time.perf_counter()
+    finished_at: dict[str, float] = {}
+
+    async def run_step(node: Node) -> None:
+        # Handlers mutate `workflow`; its outputs, the step status and the derived
+        # legacy status are saved together once the step finishes.
+        ready_at = max([finished_at.get(dep, flow_started) for dep in node.deps], default=flow_started)
+        try:
+            async with step_run(storage, thread_id, node.name, time.perf_counter() - ready_at):
+                await handlers[node.name](thread_id, workflow, storage)
+        except Exception:
+            workflow.step_status[node.name] = FAILED
+            try:
+                await storage.update_workflow(workflow)
+            except Exception as e:
+                print(f"Could not record failure of step {node.name} for {thread_id}: {e}")
+            raise
+        finished_at[node.name] = time.perf_counter()
+        workflow.step_status[node.name] = DONE
+        workflow.status = derive_status(workflow.step_status)
+        await storage.update_workflow(workflow)
+
+    errors = await run_dag(FLOW, workflow.step_status, run_step)
+    if errors:
+        for step, error in errors.items():
+            print(f"Step {step} failed for thread {thread_id}: {error!r}")
+        # The job is retried; steps already done are skipped next time.
+        raise RuntimeError(f"Generation steps failed for {thread_id}: {sorted(errors)}") from next(iter(errors.values()))
 
 
 async def _run_briefing_step(
     thread_id: str, workflow: AutoMarketState, storage: PostgresStorage
 ) -> None:
+    await storage.ensure_loaded(workflow, "conversation_transcript")
     briefing = await briefing_agent.run(workflow.conversation_transcript)
-    print(f"Briefing created for thread {thread_id}, briefing={briefing.output}")
+    record_usage(briefing)
 
     workflow.briefing_md = briefing.output
-    workflow.status = WorkflowStatus.BRIEFING_COMPLETE
-    await storage.update_workflow(workflow)
+    # The image master prompt comes from the briefing; a new briefing needs a new one
+    workflow.image_prompt = None
 
 
 async def _run_strategy_step(
     thread_id: str, workflow: AutoMarketState, storage: PostgresStorage
 ) -> None:
     strategy = await strategy_agent.run(workflow.briefing_md)
-    print(f"Strategy created for thread {thread_id}, strategy={strategy.output}")
+    record_usage(strategy)
 
     workflow.strategy_and_plan_md = strategy.output
-    workflow.status = WorkflowStatus.STRATEGY_COMPLETE
-    await storage.update_workflow(workflow)
 
 
 async def _run_calendar_step(
     thread_id: str, workflow: AutoMarketState, storage: PostgresStorage
 ) -> None:
     calendar = await calendar_agent.run(workflow.strategy_and_plan_md)
-    print(f"Calendar created for thread {thread_id}, calendar={calendar.output}")
+    record_usage(calendar)
+    print(f"Calendar created for thread {thread_id} with {len(calendar.output)} posts")
 
     workflow.calendar_events = calendar.output
     for event in workflow.calendar_events:
         event.image_url = None
-    workflow.status = WorkflowStatus.CALENDAR_COMPLETE
-    await storage.update_workflow(workflow)
-
-
-calendar_events_ta = TypeAdapter(list[CalendarPost])
+        event.render_status = None
+        event.media_id = None
 
 
-async def _render_post(calendar_post: CalendarPost, brand_info: BrandInfo):
+async def _render_post(calendar_post: CalendarPost, brand_info: BrandInfo, image_bytes: bytes | None = None):
     post = await renderer.render_to_png("post", {
         "main_text": calendar_post.title,
         "secondary_text": calendar_post.description,
         "accent_color": brand_info.main_color,
-        "image": calendar_post.image_url
+        "image": calendar_post.image_url,
+        "image_bytes": image_bytes,
     })
     return post
 
@@ -201,65 +267,87 @@ def _make_run_images_step(number: str):
         if not workflow.calendar_events:
             raise HTTPException(status_code=404, detail="Calendar events not found")
 
-        calendar_posts = calendar_events_ta.validate_json(str(workflow.calendar_events))
-        master_prompt = await image_prompt_agent.run(workflow.briefing_md)
-        user_number = await storage.get_number_by_thread_id(thread_id)
-        brand_info = await storage.get_user_brand_by_thread_id(user_number)
-
-        async def process_single_post(post: CalendarPost) -> CalendarPost:
-            """Process a single post to generate image prompts."""
+        calendar_posts = list(workflow.calendar_events)
+        # Resolved once for the whole step; `number` comes from the flow.
+        brand_info = await storage.get_user_brand_by_thread_id(number)
+        if workflow.image_prompt is None:
+            # Guardado antes de generar: un reintento reusa el mismo prompt, así las
+            # imágenes ya generadas salen del image_cache en vez de pagarse de nuevo.
+            master_prompt = await image_prompt_agent.run(workflow.briefing_md)
+            record_usage(master_prompt)
+            workflow.image_prompt = master_prompt.output
+            await storage.update_workflow(workflow)
+        master_prompt = workflow.image_prompt
+
+        async def checkpoint(index: int, post: CalendarPost, **fields) -> None:
+            """Persist this post's progress right away so a resumed run skips it."""
+            for name, value in fields.items():
+                setattr(post, name, value)
             try:
-                if post.image_url is None:
-                    image = await generate_image(
-                        f"""
-                        {master_prompt}
-                        title: {post.title}
-                        description: {post.description}""",
-                        resolution=post.resolution,
-                    )
-                    if not image or not image['image_url']:
-                        raise Exception("Failed to generate image prompts")
-                    post.image_url = image["image_url"]
-                
-                post_bytes = await _render_post(post, brand_info)
-                media_id = await upload_media_async(
-                    post_bytes.getbuffer(),
-                    mime_type="image/png",
-                    filename=f"{post.title.replace(' ', '_')}.jpg"
-                )
-                print(media_id)
-                await send_image_message_async(
-                    media_id=str(media_id),
-                    recipient=number,
-                )
-                print("Image sent successfully")
+                await storage.update_calendar_post(thread_id, index, fields)
+                workflow.mark_clean(calendar_index=index)
             except Exception as e:
-                print(f"Error processing post {post}: {e}")
-                # Continue with the next post even if one fails
-                pass
+                print(f"Could not checkpoint post {index} of {thread_id}: {e}")
+
+        async def generate(item: tuple[int, CalendarPost]) -> tuple[int, CalendarPost, bytes | None]:
+            index, post = item
+            if post.image_url is not None:
+                return index, post, None
+            image = await generate_image(
+                f"""
+                {master_prompt}
+                title: {post.title}
+                description: {post.description}""",
+                resolution=post.resolution,
+            )
+            if not image or not image['image_url']:
+                raise Exception("Failed to generate image prompts")
+            await checkpoint(index, post, image_url=image["image_url"], render_status="generated")
+            return index, post, image["image_bytes"]
+
+        async def render(item: tuple[int, CalendarPost, bytes | None]) -> tuple[int, CalendarPost, bytes]:
+            index, post, image_bytes = item
+            started = time.perf_counter()
+            post_bytes = await _render_post(post, brand_info, image_bytes)
+            record_render(time.perf_counter() - started)
+            await checkpoint(index, post, render_status="rendered")
+            return index, post, post_bytes.getvalue()
+
+        async def deliver(item: tuple[int, CalendarPost, bytes]) -> CalendarPost:
+            index, post, png = item
+            media_id = await whatsapp_client.upload_media(
+                png,
+                mime_type="image/png",
+                filename=f"{post.title.replace(' ', '_')}.jpg"
+            )
+            await whatsapp_client.send_image(number, media_id=media_id)
+            await checkpoint(index, post, media_id=str(media_id), render_status="sent")
             return post
 
-        # Run all image prompt generations concurrently
-        posts_with_images = await asyncio.gather(
-            *[process_single_post(post) for post in calendar_posts],
-            return_exceptions=True,
+        # Posts already delivered by an earlier (interrupted) run are not redone.
+        pending = [
+            (index, post) for index, post in enumerate(calendar_posts)
+            if post.render_status != "sent"
+        ]
+
+        # generate -> render -> deliver, each stage with its own worker count and
+        # bounded queues in between, so the first post reaches the user early.
+        results = await run_pipeline(
+            pending,
+            [
+                Stage("generate", generate, IMAGES_GENERATE_CONCURRENCY),
+                Stage("render", render, IMAGES_RENDER_CONCURRENCY),
+                Stage("deliver", deliver, IMAGES_DELIVER_CONCURRENCY),
+            ],
+            ordered=IMAGES_DELIVERY_MODE == "ordered",
         )
+        for (index, post), result in zip(pending, results):
+            if isinstance(result, StageError):
+                # Continue with the next post even if one fails
+                print(f"Error processing post {post}: {result}")
+                await checkpoint(index, post, render_status=f"failed:{result.stage}")
 
-        # Handle any exceptions that occurred during processing
-        successful_posts = []
-        for i, result in enumerate(posts_with_images):
-            if isinstance(result, Exception):
-                print(f"Error processing post {calendar_posts[i]}: {result}")
-                # You might want to handle this differently based on your requirements
-                # For now, we'll skip failed posts
-                continue
-            successful_posts.append(result)
-
-        posts_with_images = successful_posts
-        workflow.calendar_events = posts_with_images
-        # Store posts_with_images if needed for later steps
-        workflow.status = WorkflowStatus.IMAGES_COMPLETE
-        await storage.update_workflow(workflow)
+        workflow.calendar_events = calendar_posts
 
     return _run_images_step
 
@@ -268,7 +356,7 @@ async def _run_html_step(
     thread_id: str, workflow: AutoMarketState, storage: PostgresStorage
 ) -> None:
     html = await html_agent.run(workflow.strategy_and_plan_md)
-    print(f"HTML created for thread {thread_id}, html={html.output}")
+    record_usage(html)
 
     workflow.html_content = html.output
     workflow.status = WorkflowStatus.HTML_COMPLETE
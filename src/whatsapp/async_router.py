@@ -1,25 +1,29 @@
+import asyncio
 import base64
 
-from src.utils import save_media_bytes_to_temp
 from .model import Message
 from os import getenv
 from typing import Optional, Callable, Awaitable
 import json
 
-from fastapi import APIRouter, BackgroundTasks, HTTPException, Request
+from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import PlainTextResponse
 
 from agno.agent.agent import Agent
 from agno.media import Audio, File, Image, Video
 from agno.team.team import Team
-from agno.tools.whatsapp import WhatsAppTools
 from agno.utils.log import log_error, log_info, log_warning
-from agno.utils.whatsapp import get_media_async, send_image_message_async, typing_indicator_async, upload_media_async
-from src.veyra.workflow import run_generation_flow
+from src.veyra.jobs import GENERATION_JOB, JobQueue
+from src.veyra.message_buffer import messages_ingested
+from pydantic import TypeAdapter, ValidationError
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 from pathlib import Path
 
 
+from .dedup import message_dedup
+from .client import whatsapp_client
+from .dispatcher import DispatcherFull, LaneDispatcher, reply_started
+from .media import MediaItem, media_store
 from .security import validate_webhook_signature
 
 from langfuse import get_client
@@ -31,6 +35,15 @@ env = Environment(
     autoescape=select_autoescape(["html", "xml"])
 )
 
+messages_ta = TypeAdapter(list[Message])
+
+
+def parse_message_batch(payload: bytes, content_type: str) -> list[Message]:
+    """A JSON array of messages, or NDJSON (one message per line)."""
+    if "ndjson" in content_type or not payload.lstrip().startswith(b"["):
+        return [Message.model_validate_json(line) for line in payload.splitlines() if line.strip()]
+    return messages_ta.validate_json(payload)
+
 
 def get_async_router(agent: Optional[Agent] = None, team: Optional[Team] = None, session_state_loader: Optional[Callable[[str], Awaitable[dict]]] = None) -> APIRouter:
     router = APIRouter()
@@ -60,8 +73,12 @@ def get_async_router(agent: Optional[Agent] = None, team: Optional[Team] = None,
 
         raise HTTPException(status_code=403, detail="Invalid verify token or mode")
 
+    # One serial lane per sender: each user's messages in order, users in parallel.
+    # Messages sent in quick succession are handled as one agent turn (WHATSAPP_DEBOUNCE_MS).
+    dispatcher = LaneDispatcher(lambda messages: process_messages(messages, agent, team))
+
     @router.post("/webhook")
-    async def webhook(request: Request, background_tasks: BackgroundTasks):
+    async def webhook(request: Request):
         """Handle incoming WhatsApp messages"""
         try:
             # Get raw payload for signature validation
@@ -80,60 +97,77 @@ def get_async_router(agent: Optional[Agent] = None, team: Optional[Team] = None,
                 log_warning(f"Received non-WhatsApp webhook object: {body.get('object')}")
                 return {"status": "ignored"}
 
-            # Process messages in background
+            # Queue every message of the batch on its sender's lane
             for entry in body.get("entry", []):
                 for change in entry.get("changes", []):
-                    messages = change.get("value", {}).get("messages", [])
-
-                    if not messages:
-                        continue
-
-                    message = messages[0]
-                    background_tasks.add_task(process_message, message, agent, team)
+                    for message in change.get("value", {}).get("messages", []):
+                        message_id = message.get("id")
+                        # Redeliveries are acknowledged without reaching the agent
+                        if message_id and not await message_dedup.first_seen(message_id):
+                            continue
+                        try:
+                            await dispatcher.submit(message.get("from", ""), message)
+                        except DispatcherFull:
+                            if message_id:
+                                await message_dedup.forget(message_id)
+                            raise
 
             return {"status": "processing"}
 
+        except DispatcherFull as e:
+            # Backpressure: Meta redelivers the webhook later
+            log_warning(f"Webhook rejected: {e}")
+            raise HTTPException(status_code=503, detail="Busy, retry later")
+        except HTTPException:
+            raise
         except Exception as e:
             log_error(f"Error processing webhook: {str(e)}")
             raise HTTPException(status_code=500, detail=str(e))
 
-    async def process_message(message: dict, agent: Optional[Agent], team: Optional[Team]):
-        """Process a single WhatsApp message in the background"""
+    def parse_message(message: dict) -> Optional[tuple[str, Optional[str], Optional[str]]]:
+        """(text, media type, media id) of a webhook message, or None for unsupported types"""
+        kind = message.get("type")
+        if kind == "text":
+            return message["text"]["body"], None, None
+        elif kind == "image":
+            return message["image"].get("caption", "Esta es una imagen subida por el usuario"), "image", message["image"]["id"]
+        elif kind == "video":
+            return message["video"].get("caption", "Describe the video"), "video", message["video"]["id"]
+        elif kind == "audio":
+            return "Reply to audio", "audio", message["audio"]["id"]
+        elif kind == "document":
+            return "Process the document", "document", message["document"]["id"]
+        return None
+
+    def _media(media_cls, item: MediaItem):
+        """Large media goes to the agent as a file it reads itself; small media as the spooled bytes."""
+        extra = {"mime_type": item.mime_type} if media_cls is File else {}
+        if item.in_memory:
+            return media_cls(content=item.getvalue(), **extra)
+        return media_cls(filepath=str(item.path()), **extra)
+
+    async def process_messages(messages: list[dict], agent: Optional[Agent], team: Optional[Team]):
+        """Process one or more WhatsApp messages from the same sender as a single agent turn"""
+        phone_number = messages[-1]["from"]
         try:
-            message_image = None
-            message_video = None
-            message_audio = None
-            message_doc = None
-
-            message_id = message.get("id")
-            await typing_indicator_async(message_id)
-
-            if message.get("type") == "text":
-                message_text = message["text"]["body"]
-            elif message.get("type") == "image":
-                try:
-                    message_text = message["image"]["caption"]
-                except Exception:
-                    message_text = "Esta es una imagen subida por el usuario"
-                message_image = message["image"]["id"]
-            elif message.get("type") == "video":
-                try:
-                    message_text = message["video"]["caption"]
-                except Exception:
-                    message_text = "Describe the video"
-                message_video = message["video"]["id"]
-            elif message.get("type") == "audio":
-                message_text = "Reply to audio"
-                message_audio = message["audio"]["id"]
-            elif message.get("type") == "document":
-                message_text = "Process the document"
-                message_doc = message["document"]["id"]
-            else:
+            texts: list[str] = []
+            media: dict[str, list[str]] = {"image": [], "video": [], "audio": [], "document": []}
+            for message in messages:
+                parsed = parse_message(message)
+                if parsed is None:
+                    continue
+                text, kind, media_id = parsed
+                texts.append(text)
+                if kind:
+                    media[kind].append(media_id)
+            if not texts:
                 return
 
-            phone_number = message["from"]
+            await whatsapp_client.typing_indicator(messages[-1].get("id"))
+
+            message_text = "\n".join(texts)
             session_id = f"{phone_number}@whatsapp"
-            log_info(f"Processing message from {phone_number}: {message_text}")
+            log_info(f"Processing {len(texts)} message(s) from {phone_number}: {message_text}")
 
 
             session_state = None
@@ -142,42 +176,39 @@ def get_async_router(agent: Optional[Agent] = None, team: Optional[Team] = None,
 
             with langfuse.start_as_current_span(
                     name="wa.message",
-                    input={"message": message_text, "type": message.get("type")},
+                    input={"message": message_text, "type": [m.get("type") for m in messages]},
                 ) as message_span:
                 message_span.update_trace(
                         user_id=phone_number,
                         session_id=f"{phone_number}@whatsapp"
                     )
-                content = await get_media_async(message_image) if message_image else None
-                if content:
-                    image_path = await save_media_bytes_to_temp(content)
-                    session_state["__image_path"] = image_path
-                image = [Image(content=content)] if message_image else None
-                
-                
+                # Every media id is downloaded once, concurrently, and shared by the turn and the logo tool
+                fetched = {
+                    kind: await asyncio.gather(*(media_store.fetch(media_id) for media_id in ids))
+                    for kind, ids in media.items()
+                }
+                if fetched["image"] and session_state is not None:
+                    # The logo tool re-fetches the latest uploaded image by id (served from the store while it is cached)
+                    session_state["__image_media_id"] = fetched["image"][-1].media_id
+
+                turn = dict(
+                    user_id=phone_number,
+                    images=[_media(Image, item) for item in fetched["image"]] or None,
+                    files=[_media(File, item) for item in fetched["document"]] or None,
+                    videos=[_media(Video, item) for item in fetched["video"]] or None,
+                    audio=[_media(Audio, item) for item in fetched["audio"]] or None,
+                    session_id=session_id,
+                    session_state=session_state,
+                )
+
                 # Generate and send response
                 if agent:
-                    response = await agent.arun(
-                        message_text,
-                        user_id=phone_number,
-                        images=image,
-                        files=[File(content=await get_media_async(message_doc))] if message_doc else None,
-                        videos=[Video(content=await get_media_async(message_video))] if message_video else None,
-                        audio=[Audio(content=await get_media_async(message_audio))] if message_audio else None,
-                        session_id=session_id,
-                        session_state=session_state
-                    )
+                    response = await agent.arun(message_text, **turn)
                 elif team:
-                    response = await team.arun(
-                        message_text,
-                        user_id=phone_number,
-                        files=[File(content=await get_media_async(message_doc))] if message_doc else None,
-                        images=[Image(content=await get_media_async(message_image))] if message_image else None,
-                        videos=[Video(content=await get_media_async(message_video))] if message_video else None,
-                        audio=[Audio(content=await get_media_async(message_audio))] if message_audio else None,
-                        session_id=session_id,
-                        session_state=session_state
-                    )
+                    response = await team.arun(message_text, **turn)
+
+                # From here on the user sees output, so the turn can no longer be restarted
+                reply_started()
 
                 if response.reasoning_content:
                     await _send_whatsapp_message(phone_number, f"Reasoning: \n{response.reasoning_content}", italics=True)
@@ -201,10 +232,10 @@ def get_async_router(agent: Optional[Agent] = None, team: Optional[Team] = None,
                             log_error(f"Unexpected image content type: {type(image_content)} for user {phone_number}")
 
                         if image_bytes:
-                            media_id = await upload_media_async(
-                                media_data=image_bytes, mime_type="image/png", filename="image.png"
+                            media_id = await whatsapp_client.upload_media(
+                                image_bytes, mime_type="image/png", filename="image.png"
                             )
-                            await send_image_message_async(media_id=media_id, recipient=phone_number, text=response.content)
+                            await whatsapp_client.send_image(phone_number, media_id=media_id, caption=response.content)
                         else:
                             log_warning(
                                 f"Could not process image content for user {phone_number}. Type: {type(image_content)}"
@@ -227,10 +258,36 @@ def get_async_router(agent: Optional[Agent] = None, team: Optional[Team] = None,
     async def receive_message(request: Request):
         payload = await request.body()
         parsed = Message.model_validate_json(payload)
-        storage = request.app.state.storage
-        await storage.insert_message(parsed)
+        buffer = request.app.state.message_buffer
+        if buffer is not None:
+            await buffer.add(parsed)
+        else:
+            storage = request.app.state.storage
+            await storage.insert_message(parsed)
+            messages_ingested.inc(path="single")
         return payload
 
+    @router.post("/messages/batch")
+    async def receive_messages_batch(request: Request):
+        payload = await request.body()
+        try:
+            messages = parse_message_batch(payload, request.headers.get("content-type", ""))
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors())
+        storage = request.app.state.storage
+        inserted = await storage.insert_messages(messages)
+        messages_ingested.inc(inserted, path="batch")
+        return {"received": len(messages), "inserted": inserted}
+
+    @router.get("/threads/{thread_id}/messages")
+    async def list_thread_messages(thread_id: str, request: Request, cursor: Optional[str] = None, limit: int = 100):
+        storage = request.app.state.storage
+        try:
+            messages, next_cursor = await storage.list_messages(thread_id, cursor, max(1, min(limit, 500)))
+        except (ValueError, UnicodeDecodeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        return {"messages": messages, "next_cursor": next_cursor}
+
     @router.get("/brands/{phone}")
     async def get_brand_by_phone(phone: str, request: Request):
         storage = request.app.state.storage
@@ -238,16 +295,21 @@ def get_async_router(agent: Optional[Agent] = None, team: Optional[Team] = None,
         return brand
 
     @router.post("/call_ended")
-    async def call_ended(request: Request, background_task: BackgroundTasks):
+    async def call_ended(request: Request):
         # TODO get conversation 
         payload = await request.body()
         parsed = json.loads(payload)
         conversation_id = parsed["conversation_id"]
         phone_numer = parsed["phone_number"]
-        storage = request.app.state.storage
+        jobs: JobQueue = request.app.state.jobs
+        if request.app.state.message_buffer is not None:
+            # The transcript must be complete before the generation reads it
+            await request.app.state.message_buffer.flush()
         await _send_whatsapp_message(phone_numer, "Estamos trabajando en potenciar tu negocio, en unos minutos te enviaremos el resultado.")
         
-        background_task.add_task(run_generation_flow, thread_id=conversation_id, storage=storage)
+        # Durable: picked up by a worker, survives machine stops and deploys.
+        # A repeated trigger for the same conversation reuses the job already queued/running.
+        await jobs.enqueue(GENERATION_JOB, {"thread_id": conversation_id}, dedup_key=conversation_id)
         # TODO: Include this message in the agent context
         print("Call ended!")
 
@@ -258,9 +320,9 @@ def get_async_router(agent: Optional[Agent] = None, team: Optional[Team] = None,
             if italics:
                 # Handle multi-line messages by making each line italic
                 formatted_message = "\n".join([f"_{line}_" for line in message.split("\n")])
-                await WhatsAppTools().send_text_message_async(recipient=recipient, text=formatted_message)
+                await whatsapp_client.send_text(recipient, formatted_message)
             else:
-                await WhatsAppTools().send_text_message_async(recipient=recipient, text=message)
+                await whatsapp_client.send_text(recipient, message)
             return
 
         # Split message into batches of 4000 characters (WhatsApp message limit is 4096)
@@ -272,8 +334,8 @@ def get_async_router(agent: Optional[Agent] = None, team: Optional[Team] = None,
             if italics:
                 # Handle multi-line messages by making each line italic
                 formatted_batch = "\n".join([f"_{line}_" for line in batch_message.split("\n")])
-                await WhatsAppTools().send_text_message_async(recipient=recipient, text=formatted_batch)
+                await whatsapp_client.send_text(recipient, formatted_batch)
             else:
-                await WhatsAppTools().send_text_message_async(recipient=recipient, text=batch_message)
+                await whatsapp_client.send_text(recipient, batch_message)
 
     return router
\ No newline at end of file
@@ -0,0 +1,240 @@
+"""
+Shared WhatsApp Cloud API client.
+
+One pooled httpx client per process (HTTP/2 when `h2` is installed, keep-alive
+otherwise), opened by the app runtime and reused by the routers, the workflow
+and the media store, so sends do not pay for connection setup. Calls to the
+Graph API go through a token bucket sized to the phone number's throughput tier
+(WHATSAPP_RATE_LIMIT_MPS), and 429/5xx answers are retried with jittered
+exponential backoff, honouring Retry-After when Meta sends it.
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from os import getenv
+from typing import Any, AsyncIterator, Optional
+
+import httpx
+from agno.utils.log import log_debug, log_error, log_warning
+
+from src.veyra.metrics import counter, histogram
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:  # h2 es opcional (extra `http2`)
+    HTTP2_AVAILABLE = False
+
+WHATSAPP_GRAPH_API_VERSION = getenv("WHATSAPP_GRAPH_API_VERSION", "v22.0")
+WHATSAPP_HTTP2 = getenv("WHATSAPP_HTTP2", "true").lower() in ("1", "true", "yes")
+WHATSAPP_MAX_CONNECTIONS = int(getenv("WHATSAPP_MAX_CONNECTIONS", "20"))
+WHATSAPP_KEEPALIVE_SECONDS = float(getenv("WHATSAPP_KEEPALIVE_SECONDS", "60"))
+# Cloud API default throughput is 80 messages/s per phone number (up to 1000 on higher tiers)
+WHATSAPP_RATE_LIMIT_MPS = float(getenv("WHATSAPP_RATE_LIMIT_MPS", "80"))
+WHATSAPP_RATE_LIMIT_BURST = int(getenv("WHATSAPP_RATE_LIMIT_BURST", "80"))
+WHATSAPP_MAX_RETRIES = int(getenv("WHATSAPP_MAX_RETRIES", "3"))
+WHATSAPP_RETRY_BASE_SECONDS = float(getenv("WHATSAPP_RETRY_BASE_SECONDS", "0.5"))
+WHATSAPP_RETRY_MAX_SECONDS = float(getenv("WHATSAPP_RETRY_MAX_SECONDS", "8"))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+api_requests = counter("whatsapp_api_requests_total", "Graph API requests, by endpoint and status")
+api_retries = counter("whatsapp_api_retries_total", "Graph API requests retried, by reason")
+api_seconds = histogram("whatsapp_api_seconds", "Graph API request latency, by endpoint")
+rate_limit_wait = histogram("whatsapp_rate_limit_wait_seconds", "Time spent waiting for the send rate limiter")
+
+
+class TokenBucket:
+    """`rate` tokens per second, up to `capacity`; waiters are served in order."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """Take one token; returns how long it had to wait."""
+        if self.rate <= 0:
+            return 0.0
+        start = time.monotonic()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return now - start
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class WhatsAppClient:
+    def __init__(
+        self,
+        access_token: Optional[str] = None,
+        phone_number_id: Optional[str] = None,
+        version: str = WHATSAPP_GRAPH_API_VERSION,
+        rate: float = WHATSAPP_RATE_LIMIT_MPS,
+        burst: int = WHATSAPP_RATE_LIMIT_BURST,
+        max_retries: int = WHATSAPP_MAX_RETRIES,
+    ):
+        self.access_token = access_token
+        self.phone_number_id = phone_number_id
+        self.base_url = f"https://graph.facebook.com/{version}"
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate, burst)
+        self._http: httpx.AsyncClient | None = None
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        """The pooled client; created on first use if the runtime has not opened it."""
+        if self._http is None or self._http.is_closed:
+            self.open()
+        return self._http
+
+    def open(self) -> None:
+        if self._http is not None and not self._http.is_closed:
+            return
+        self._http = httpx.AsyncClient(
+            http2=WHATSAPP_HTTP2 and HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=WHATSAPP_MAX_CONNECTIONS,
+                max_keepalive_connections=WHATSAPP_MAX_CONNECTIONS,
+                keepalive_expiry=WHATSAPP_KEEPALIVE_SECONDS,
+            ),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+        )
+
+    async def close(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def _headers(self) -> dict[str, str]:
+        return {"Authorization": f"Bearer {self.access_token or getenv('WHATSAPP_ACCESS_TOKEN')}"}
+
+    def _phone_number_id(self) -> str:
+        phone_number_id = self.phone_number_id or getenv("WHATSAPP_PHONE_NUMBER_ID")
+        if not phone_number_id:
+            raise ValueError("WHATSAPP_PHONE_NUMBER_ID is not set")
+        return phone_number_id
+
+    async def request(self, method: str, path: str, endpoint: str, **kwargs) -> httpx.Response:
+        """Rate-limited Graph API call, retried on 429/5xx and on connections that never got through."""
+        attempt = 0
+        while True:
+            waited = await self.bucket.acquire()
+            rate_limit_wait.observe(waited)
+            started = time.perf_counter()
+            try:
+                response = await self.http.request(method, f"{self.base_url}/{path}", headers=self._headers(), **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                # The request was not sent, so retrying cannot duplicate a message
+                if attempt >= self.max_retries:
+                    api_requests.inc(endpoint=endpoint, status="error")
+                    raise
+                reason, retry_after = type(e).__name__, None
+            else:
+                api_seconds.observe(time.perf_counter() - started, endpoint=endpoint)
+                api_requests.inc(endpoint=endpoint, status=str(response.status_code))
+                if response.status_code not in RETRYABLE_STATUS or attempt >= self.max_retries:
+                    if response.is_error:
+                        log_error(f"WhatsApp {endpoint} failed: {response.status_code} {response.text}")
+                    response.raise_for_status()
+                    return response
+                reason, retry_after = str(response.status_code), response.headers.get("Retry-After")
+
+            attempt += 1
+            api_retries.inc(endpoint=endpoint, reason=reason)
+            await asyncio.sleep(self._backoff(attempt, retry_after))
+
+    @staticmethod
+    def _backoff(attempt: int, retry_after: Optional[str]) -> float:
+        # Full jitter keeps replicas that were throttled together from retrying together
+        delay = random.uniform(0, min(WHATSAPP_RETRY_MAX_SECONDS, WHATSAPP_RETRY_BASE_SECONDS * 2 ** attempt))
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
+
+    async def _send(self, payload: dict[str, Any]) -> dict:
+        payload = {"messaging_product": "whatsapp", "recipient_type": "individual", **payload}
+        log_debug(f"Sending WhatsApp {payload.get('type')} to {payload.get('to')}")
+        response = await self.request("POST", f"{self._phone_number_id()}/messages", "messages", json=payload)
+        return response.json()
+
+    async def send_text(self, recipient: str, text: str, preview_url: bool = False) -> dict:
+        return await self._send(
+            {"to": recipient, "type": "text", "text": {"preview_url": preview_url, "body": text}}
+        )
+
+    async def send_image(
+        self,
+        recipient: str,
+        media_id: Optional[str] = None,
+        link: Optional[str] = None,
+        caption: Optional[str] = None,
+    ) -> dict:
+        if media_id is None and link is None:
+            raise ValueError("Either media_id or link must be provided.")
+        image: dict[str, str] = {"id": media_id} if media_id is not None else {"link": link}
+        if caption:
+            image["caption"] = caption
+        return await self._send({"to": recipient, "type": "image", "image": image})
+
+    async def upload_media(self, data: bytes, mime_type: str, filename: str = "file") -> str:
+        """Upload media to the phone number and return its media id."""
+        response = await self.request(
+            "POST",
+            f"{self._phone_number_id()}/media",
+            "media_upload",
+            data={"messaging_product": "whatsapp", "type": mime_type},
+            files={"file": (filename, data, mime_type)},
+        )
+        body = response.json()
+        media_id = body.get("id")
+        if not media_id:
+            raise RuntimeError(f"Media upload did not return an id: {body}")
+        return media_id
+
+    async def typing_indicator(self, message_id: Optional[str]) -> None:
+        """Mark the message as read and show "typing…"; best effort."""
+        if not message_id:
+            return
+        try:
+            await self.request(
+                "POST",
+                f"{self._phone_number_id()}/messages",
+                "typing",
+                json={
+                    "messaging_product": "whatsapp",
+                    "status": "read",
+                    "message_id": message_id,
+                    "typing_indicator": {"type": "text"},
+                },
+            )
+        except Exception as e:
+            log_warning(f"Typing indicator failed: {e}")
+
+    async def media_info(self, media_id: str) -> dict:
+        """Download URL, mime type and size of an incoming media id."""
+        response = await self.request("GET", media_id, "media_info")
+        return response.json()
+
+    @asynccontextmanager
+    async def stream_media(self, url: str) -> AsyncIterator[httpx.Response]:
+        """Stream a media download URL (the CDN is not subject to the send rate limit)."""
+        async with self.http.stream("GET", url, headers=self._headers()) as response:
+            response.raise_for_status()
+            yield response
+
+
+whatsapp_client = WhatsAppClient()
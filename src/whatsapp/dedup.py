@@ -0,0 +1,100 @@
+"""
+Idempotent webhook intake: remembers which WhatsApp message ids were already
+accepted, so Meta's redeliveries are acknowledged without running the agent again.
+
+An in-process LRU answers repeats seen by this replica; the
+`processed_webhook_messages` table (unique on message_id) catches the ones that
+land on another replica. Rows older than the retention window are purged.
+"""
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from os import getenv
+
+import asyncpg
+from agno.utils.log import log_warning
+
+from src.veyra.metrics import counter
+
+WEBHOOK_DEDUP_MEMORY_SIZE = int(getenv("WEBHOOK_DEDUP_MEMORY_SIZE", "10000"))
+WEBHOOK_DEDUP_RETENTION_HOURS = float(getenv("WEBHOOK_DEDUP_RETENTION_HOURS", "72"))
+WEBHOOK_DEDUP_PURGE_EVERY = int(getenv("WEBHOOK_DEDUP_PURGE_EVERY", "500"))
+
+duplicates_total = counter("webhook_duplicates_total", "Redelivered webhook messages dropped, by layer")
+
+
+class MessageDedup:
+    def __init__(
+        self,
+        memory_size: int = WEBHOOK_DEDUP_MEMORY_SIZE,
+        retention_hours: float = WEBHOOK_DEDUP_RETENTION_HOURS,
+    ):
+        self.pool: asyncpg.Pool | None = None
+        self.memory_size = memory_size
+        self.retention_seconds = retention_hours * 3600
+        # message_id -> time first seen
+        self._seen: OrderedDict[str, float] = OrderedDict()
+        self._inserts = 0
+
+    def attach(self, pool: asyncpg.Pool | None) -> None:
+        self.pool = pool
+
+    async def first_seen(self, message_id: str) -> bool:
+        """Claim `message_id`; False if it was already claimed here or on another replica."""
+        seen_at = self._seen.get(message_id)
+        if seen_at is not None and time.monotonic() - seen_at < self.retention_seconds:
+            duplicates_total.inc(layer="memory")
+            return False
+
+        if self.pool is not None:
+            try:
+                claimed = await self.pool.fetchval(
+                    """
+                    INSERT INTO processed_webhook_messages (message_id) VALUES ($1)
+                    ON CONFLICT (message_id) DO NOTHING
+                    RETURNING message_id
+                    """,
+                    message_id,
+                )
+                if claimed is None:
+                    self._remember(message_id)
+                    duplicates_total.inc(layer="postgres")
+                    return False
+                self._inserts += 1
+                if self._inserts % WEBHOOK_DEDUP_PURGE_EVERY == 0:
+                    await self.purge()
+            except Exception as e:
+                # Better to risk a double reply than to drop a message
+                log_warning(f"Webhook dedup lookup failed: {e}")
+
+        self._remember(message_id)
+        return True
+
+    async def forget(self, message_id: str) -> None:
+        """Release a claim for a message we did not accept, so its redelivery goes through."""
+        self._seen.pop(message_id, None)
+        if self.pool is not None:
+            try:
+                await self.pool.execute(
+                    "DELETE FROM processed_webhook_messages WHERE message_id = $1", message_id
+                )
+            except Exception as e:
+                log_warning(f"Webhook dedup release failed: {e}")
+
+    async def purge(self) -> None:
+        if self.pool is None:
+            return
+        await self.pool.execute(
+            "DELETE FROM processed_webhook_messages WHERE received_at < NOW() - make_interval(secs => $1)",
+            self.retention_seconds,
+        )
+
+    def _remember(self, message_id: str) -> None:
+        self._seen[message_id] = time.monotonic()
+        self._seen.move_to_end(message_id)
+        while len(self._seen) > self.memory_size:
+            self._seen.popitem(last=False)
+
+
+message_dedup = MessageDedup()
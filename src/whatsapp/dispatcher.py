@@ -0,0 +1,190 @@
+"""
+Per-sender serial lanes for incoming WhatsApp messages.
+
+Messages with the same key (the sender's phone number) are handled one at a time
+and in arrival order; different senders run in parallel, up to a global
+concurrency cap. A busy sender only ever holds one slot, so it cannot starve the
+others. When too much work is pending, `submit` waits briefly and then raises
+DispatcherFull so the webhook can answer 503 and let Meta redeliver later.
+
+With a debounce window, a lane waits until its sender has been quiet for
+`debounce` seconds (at most `max_debounce`) and hands everything queued to the
+handler as one batch, so rapid-fire messages become a single agent turn.
+Messages arriving while that turn runs are either absorbed into the next batch
+("absorb") or, if the handler has not started replying yet, cancel the turn and
+restart it with all messages ("restart"). Handlers mark that point with
+`reply_started()`.
+"""
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from contextvars import ContextVar
+from os import getenv
+from typing import Any, Awaitable, Callable
+
+from agno.utils.log import log_error
+
+from src.veyra.metrics import counter, gauge
+
+WHATSAPP_MAX_CONCURRENCY = int(getenv("WHATSAPP_MAX_CONCURRENCY", "16"))
+WHATSAPP_MAX_PENDING = int(getenv("WHATSAPP_MAX_PENDING", "1000"))
+WHATSAPP_MAX_PENDING_PER_SENDER = int(getenv("WHATSAPP_MAX_PENDING_PER_SENDER", "50"))
+WHATSAPP_SUBMIT_TIMEOUT = float(getenv("WHATSAPP_SUBMIT_TIMEOUT", "2"))
+WHATSAPP_DEBOUNCE_MS = int(getenv("WHATSAPP_DEBOUNCE_MS", "0"))
+WHATSAPP_MAX_DEBOUNCE_MS = int(getenv("WHATSAPP_MAX_DEBOUNCE_MS", "5000"))
+WHATSAPP_DEBOUNCE_MODE = getenv("WHATSAPP_DEBOUNCE_MODE", "absorb")  # absorb | restart
+WHATSAPP_MAX_RESTARTS = int(getenv("WHATSAPP_MAX_RESTARTS", "2"))
+
+pending_gauge = gauge("whatsapp_dispatch_pending", "Incoming messages queued or being handled")
+lanes_gauge = gauge("whatsapp_dispatch_lanes", "Senders with queued or running messages")
+rejected_total = counter("whatsapp_dispatch_rejected_total", "Messages refused because the dispatcher was full")
+turns_total = counter("whatsapp_dispatch_turns_total", "Handler runs (agent turns) started")
+coalesced_total = counter("whatsapp_dispatch_coalesced_total", "Messages merged into another message's turn")
+restarts_total = counter("whatsapp_dispatch_restarts_total", "Turns cancelled and restarted to include late messages")
+
+_reply_started: ContextVar[asyncio.Event | None] = ContextVar("reply_started", default=None)
+
+
+def reply_started() -> None:
+    """Called by a handler before its first side effect; the turn can no longer be restarted."""
+    event = _reply_started.get()
+    if event is not None:
+        event.set()
+
+
+class DispatcherFull(Exception):
+    """Raised when a message could not be queued within the submit timeout."""
+
+    pass
+
+
+class LaneDispatcher:
+    """Runs `handler(batch)` per lane; batches hold one item unless a debounce window is set."""
+
+    def __init__(
+        self,
+        handler: Callable[[list], Awaitable[None]],
+        max_concurrency: int = WHATSAPP_MAX_CONCURRENCY,
+        max_pending: int = WHATSAPP_MAX_PENDING,
+        max_pending_per_lane: int = WHATSAPP_MAX_PENDING_PER_SENDER,
+        submit_timeout: float = WHATSAPP_SUBMIT_TIMEOUT,
+        debounce: float = WHATSAPP_DEBOUNCE_MS / 1000,
+        max_debounce: float = WHATSAPP_MAX_DEBOUNCE_MS / 1000,
+        mode: str = WHATSAPP_DEBOUNCE_MODE,
+        max_restarts: int = WHATSAPP_MAX_RESTARTS,
+    ):
+        self.handler = handler
+        self.max_pending = max_pending
+        self.max_pending_per_lane = max_pending_per_lane
+        self.submit_timeout = submit_timeout
+        self.debounce = debounce
+        self.max_debounce = max_debounce
+        self.mode = mode
+        self.max_restarts = max_restarts
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._lanes: dict[str, deque] = {}
+        self._arrivals: dict[str, asyncio.Event] = {}
+        self._workers: dict[str, asyncio.Task] = {}
+        self._pending = 0
+        self._space = asyncio.Condition()
+
+    async def submit(self, key: str, item: Any) -> None:
+        """Queue `item` on `key`'s lane, waiting up to `submit_timeout` for room."""
+        async with self._space:
+            try:
+                await asyncio.wait_for(
+                    self._space.wait_for(lambda: self._has_room(key)), timeout=self.submit_timeout
+                )
+            except asyncio.TimeoutError:
+                rejected_total.inc()
+                raise DispatcherFull(f"Dispatcher full ({self._pending} pending)") from None
+            self._lanes.setdefault(key, deque()).append(item)
+            self._pending += 1
+        self._arrivals.setdefault(key, asyncio.Event()).set()
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._run_lane(key))
+        self._report()
+
+    def _has_room(self, key: str) -> bool:
+        lane = self._lanes.get(key)
+        return self._pending < self.max_pending and (lane is None or len(lane) < self.max_pending_per_lane)
+
+    async def _run_lane(self, key: str) -> None:
+        lane = self._lanes[key]
+        try:
+            while lane:
+                await self._wait_quiet(key)
+                async with self._slots:
+                    batch = await self._run_turn(key, lane)
+                for _ in batch:
+                    lane.popleft()
+                async with self._space:
+                    self._pending -= len(batch)
+                    self._space.notify_all()
+                self._report()
+        finally:
+            del self._lanes[key]
+            self._arrivals.pop(key, None)
+            del self._workers[key]
+            self._report()
+
+    def _take(self, lane: deque) -> list:
+        return list(lane) if self.debounce > 0 else [lane[0]]
+
+    async def _wait_quiet(self, key: str) -> None:
+        """Wait until no message arrived on the lane for `debounce` seconds (capped at `max_debounce`)."""
+        if self.debounce <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_debounce
+        arrival = self._arrivals[key]
+        while True:
+            arrival.clear()
+            timeout = min(self.debounce, deadline - loop.time())
+            if timeout <= 0:
+                return
+            try:
+                await asyncio.wait_for(arrival.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return
+
+    async def _run_turn(self, key: str, lane: deque) -> list:
+        """Run the handler on the lane's next batch and return the batch it finally handled."""
+        arrival = self._arrivals[key]
+        restarts = 0
+        while True:
+            batch = self._take(lane)
+            turns_total.inc()
+            if len(batch) > 1:
+                coalesced_total.inc(len(batch) - 1)
+            arrival.clear()
+            replying = asyncio.Event()
+            turn = asyncio.create_task(self._call(key, batch, replying))
+            if self.mode != "restart" or self.debounce <= 0 or restarts >= self.max_restarts:
+                await turn
+                return batch
+
+            arrived = asyncio.create_task(arrival.wait())
+            await asyncio.wait({turn, arrived}, return_when=asyncio.FIRST_COMPLETED)
+            arrived.cancel()
+            if turn.done() or replying.is_set():
+                await turn
+                return batch
+            # A late message came in before the reply went out: start over with it
+            turn.cancel()
+            await asyncio.gather(turn, return_exceptions=True)
+            restarts += 1
+            restarts_total.inc()
+            await self._wait_quiet(key)
+
+    async def _call(self, key: str, batch: list, replying: asyncio.Event) -> None:
+        _reply_started.set(replying)
+        try:
+            await self.handler(batch)
+        except Exception as e:
+            log_error(f"Error handling messages for {key}: {e}")
+
+    def _report(self) -> None:
+        pending_gauge.set(self._pending)
+        lanes_gauge.set(len(self._workers))
@@ -0,0 +1,220 @@
+"""
+Media fetch layer for incoming WhatsApp messages.
+
+Each media id is downloaded once (concurrent requests share the download and
+later ones reuse the result until it expires). The body is streamed into a
+spool that stays in memory below WHATSAPP_MEDIA_SPOOL_MB and moves to a file in
+WHATSAPP_MEDIA_DIR above it, so large videos/documents are never held in RAM.
+Files are deleted once the item is older than WHATSAPP_MEDIA_TTL_SECONDS, and
+in-memory items kept for reuse are capped at WHATSAPP_MEDIA_MEMORY_MB in total
+(least recently used go first).
+"""
+from __future__ import annotations
+
+import asyncio
+import io
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import suppress
+from os import getenv
+from pathlib import Path
+
+from agno.utils.log import log_info
+
+from src.veyra.metrics import counter
+
+from .client import WhatsAppClient, whatsapp_client
+
+MB = 1024 * 1024
+WHATSAPP_MEDIA_SPOOL_MB = float(getenv("WHATSAPP_MEDIA_SPOOL_MB", "8"))
+WHATSAPP_MEDIA_TTL_SECONDS = float(getenv("WHATSAPP_MEDIA_TTL_SECONDS", "3600"))
+WHATSAPP_MEDIA_MEMORY_MB = float(getenv("WHATSAPP_MEDIA_MEMORY_MB", "64"))
+WHATSAPP_MEDIA_DIR = Path(getenv("WHATSAPP_MEDIA_DIR") or os.path.join(tempfile.gettempdir(), "veyra-media"))
+CHUNK_SIZE = 64 * 1024
+
+media_fetches = counter("whatsapp_media_fetches_total", "Media lookups, by result (downloaded, reused)")
+media_bytes = counter("whatsapp_media_bytes_total", "Media bytes downloaded, by where they were spooled")
+
+
+class MediaItem:
+    """A downloaded media object, in memory or spooled to disk."""
+
+    def __init__(self, media_id: str, mime_type: str | None, max_memory: int):
+        self.media_id = media_id
+        self.mime_type = mime_type
+        self.size = 0
+        self.created_at = time.monotonic()
+        self._max_memory = max_memory
+        self._buffer: io.BytesIO | None = io.BytesIO()
+        self._path: Path | None = None
+        self._file = None
+
+    @property
+    def in_memory(self) -> bool:
+        return self._buffer is not None
+
+    async def write(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self._buffer is not None and self.size > self._max_memory:
+            await asyncio.to_thread(self._rollover)
+        if self._buffer is not None:
+            self._buffer.write(chunk)
+        else:
+            await asyncio.to_thread(self._file.write, chunk)
+
+    def _rollover(self) -> None:
+        WHATSAPP_MEDIA_DIR.mkdir(parents=True, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=WHATSAPP_MEDIA_DIR, prefix=f"{self.media_id}-", delete=False)
+        self._path = Path(self._file.name)
+        self._file.write(self._buffer.getbuffer())
+        self._buffer = None
+
+    async def finish(self) -> None:
+        if self._file is not None:
+            await asyncio.to_thread(self._file.close)
+            self._file = None
+
+    def view(self) -> memoryview:
+        """Zero-copy view of an in-memory item."""
+        if self._buffer is None:
+            raise ValueError(f"Media {self.media_id} is on disk, use path()")
+        return self._buffer.getbuffer()
+
+    def getvalue(self) -> bytes:
+        """The content as bytes (shares the spool's buffer when it can; reads the file for disk items)."""
+        if self._buffer is not None:
+            return self._buffer.getvalue()
+        return self._path.read_bytes()
+
+    def path(self) -> Path:
+        """A file with the content, written once for in-memory items."""
+        if self._path is None:
+            WHATSAPP_MEDIA_DIR.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=WHATSAPP_MEDIA_DIR, prefix=f"{self.media_id}-", delete=False) as f:
+                f.write(self._buffer.getbuffer())
+                self._path = Path(f.name)
+        return self._path
+
+    def remove_file(self) -> None:
+        if self._path is not None:
+            self._path.unlink(missing_ok=True)
+
+    def discard(self) -> None:
+        self.remove_file()
+        self._buffer = None
+
+
+class MediaStore:
+    def __init__(
+        self,
+        client: WhatsAppClient = whatsapp_client,
+        max_memory: int = int(WHATSAPP_MEDIA_SPOOL_MB * MB),
+        ttl_seconds: float = WHATSAPP_MEDIA_TTL_SECONDS,
+        memory_budget: int = int(WHATSAPP_MEDIA_MEMORY_MB * MB),
+    ):
+        self.client = client
+        self.max_memory = max_memory
+        self.ttl_seconds = ttl_seconds
+        self.memory_budget = memory_budget
+        self._items: OrderedDict[str, MediaItem] = OrderedDict()
+        self._memory_used = 0
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._sweeper: asyncio.Task | None = None
+
+    async def fetch(self, media_id: str) -> MediaItem:
+        item = self._items.get(media_id)
+        if item is not None:
+            self._items.move_to_end(media_id)
+            media_fetches.inc(result="reused")
+            return item
+        self._ensure_sweeper()
+        task = self._inflight.get(media_id)
+        if task is None:
+            task = asyncio.create_task(self._download(media_id))
+            self._inflight[media_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(media_id, None))
+        else:
+            media_fetches.inc(result="reused")
+        return await asyncio.shield(task)
+
+    async def _download(self, media_id: str) -> MediaItem:
+        meta = await self.client.media_info(media_id)
+
+        item = MediaItem(media_id, meta.get("mime_type"), self.max_memory)
+        try:
+            async with self.client.stream_media(meta["url"]) as body:
+                async for chunk in body.aiter_bytes(CHUNK_SIZE):
+                    await item.write(chunk)
+            await item.finish()
+        except BaseException:
+            await item.finish()
+            item.discard()
+            raise
+        self._items[media_id] = item
+        if item.in_memory:
+            self._memory_used += item.size
+            self._evict()
+        media_fetches.inc(result="downloaded")
+        media_bytes.inc(item.size, spool="memory" if item.in_memory else "disk")
+        return item
+
+    def _evict(self) -> None:
+        """Drop least recently used in-memory items until they fit the memory budget."""
+        for media_id, item in list(self._items.items()):
+            if self._memory_used <= self.memory_budget:
+                return
+            if item.in_memory:
+                # Only the reference is dropped: a turn still holding the item keeps its bytes
+                del self._items[media_id]
+                self._memory_used -= item.size
+                item.remove_file()
+
+    def _remove(self, media_id: str) -> None:
+        item = self._items.pop(media_id)
+        if item.in_memory:
+            self._memory_used -= item.size
+        item.discard()
+
+    def _ensure_sweeper(self) -> None:
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def _sweep_forever(self) -> None:
+        await asyncio.to_thread(self._remove_stale_files)
+        while True:
+            await asyncio.sleep(max(1.0, self.ttl_seconds / 4))
+            self.sweep()
+
+    def sweep(self) -> None:
+        """Drop items older than the TTL and delete their files."""
+        now = time.monotonic()
+        for media_id, item in list(self._items.items()):
+            if now - item.created_at > self.ttl_seconds:
+                self._remove(media_id)
+
+    def _remove_stale_files(self) -> None:
+        """Delete files left behind by earlier processes."""
+        if not WHATSAPP_MEDIA_DIR.exists():
+            return
+        cutoff = time.time() - self.ttl_seconds
+        removed = 0
+        for path in WHATSAPP_MEDIA_DIR.iterdir():
+            with suppress(OSError):
+                if path.is_file() and path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+        if removed:
+            log_info(f"Removed {removed} stale media files from {WHATSAPP_MEDIA_DIR}")
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._sweeper
+        for media_id in list(self._items):
+            self._remove(media_id)
+
+
+media_store = MediaStore()
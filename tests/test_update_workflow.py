@@ -0,0 +1,73 @@
+import asyncio
+import os
+import re
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+os.environ.setdefault("POSTGRES_URL", "postgresql://test@localhost/test")
+
+from src.veyra.models import AutoMarketState, WorkflowStatus  # noqa: E402
+from src.veyra.persistence import PostgresStorage  # noqa: E402
+
+
+class StubPool:
+    """Answers the optimistic UPDATE like Postgres would; the first one waits for `release`."""
+
+    def __init__(self, version: int):
+        self.version = version
+        self.updates: list[tuple[str, tuple]] = []
+        self.release = asyncio.Event()
+        self.in_flight = asyncio.Event()
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self
+
+    async def fetchrow(self, query: str, *args):
+        self.updates.append((query, args))
+        if len(self.updates) == 1:
+            self.in_flight.set()
+            await self.release.wait()
+        if args[1] != self.version:
+            return None
+        self.version += 1
+        return {"version": self.version, "updated_at": datetime.now(timezone.utc)}
+
+
+def test_overlapping_saves_keep_changes_made_while_the_first_is_in_flight():
+    async def scenario():
+        pool = StubPool(version=3)
+        storage = PostgresStorage(pool)
+        state = AutoMarketState(
+            thread_id="t1",
+            status=WorkflowStatus.CALENDAR_COMPLETE,
+            conversation_transcript="",
+            step_status={"briefing": "done", "strategy": "done", "calendar": "done"},
+            version=3,
+        )
+
+        # v0_page finishes first and starts saving
+        state.step_status["v0_page"] = "done"
+        first = asyncio.create_task(storage.update_workflow(state))
+        await pool.in_flight.wait()
+
+        # images finishes while that UPDATE is still running
+        state.step_status["images"] = "done"
+        state.status = WorkflowStatus.IMAGES_COMPLETE
+        second = asyncio.create_task(storage.update_workflow(state))
+        await asyncio.sleep(0)
+        pool.release.set()
+        await asyncio.gather(first, second)
+        return pool, state
+
+    pool, state = asyncio.run(scenario())
+
+    assert len(pool.updates) == 2
+    query, args = pool.updates[1]
+    assert "step_status =" in query and re.search(r"(?<!_)status =", query)
+    assert any('"images": "done"' in str(arg) for arg in args)
+    assert WorkflowStatus.IMAGES_COMPLETE in args
+    assert state.status == WorkflowStatus.IMAGES_COMPLETE
+    assert state.version == 5
+    assert state.dirty_fields() == set()